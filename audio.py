@@ -1,151 +1,396 @@
+import collections
 import numpy as np
-import queue
-from collections import deque
 import discord
-import resampy
 import freedv
+from resampler import StreamingResampler
+from ring_buffer import PCMRingBuffer
+from jitter import JitterBuffer, DriftCorrector, TXBuffer
+from recorder import QSORecorder
+from pipeline import PipelineStage
+import metrics
+import kernels
+import time
+
+
+# largest gain apply_gain_q15 can use without overflowing int32
+MAX_Q15_GAIN = 65535
 
 
 def generate_silence(nframes):
     return b'\x00\x00' * nframes
 
 
-def stereo_to_mono(samples: bytes, output_bytes: bool = True):
-    lchannel = b''
-    rchannel = b''
+def as_int16(samples):
+    if isinstance(samples, np.ndarray):
+        return samples
+    return np.frombuffer(samples, dtype=np.int16)
+
+
+def stereo_to_mono(samples, output_bytes: bool = True, out: np.ndarray | None = None):
+    # L + R summed in int32 and saturated back to int16
+    stereo = as_int16(samples)
 
-    for i in range(0, len(samples), 4):
-        lchannel += samples[i:i + 2]
-        rchannel += samples[i + 2:i + 4]
+    if out is None:
+        out = np.empty(len(stereo) // 2, dtype=np.int16)
 
-    output = np.frombuffer(lchannel, dtype=np.int16)
-    output = output + np.frombuffer(rchannel, dtype=np.int16)
+    out = out[:len(stereo) // 2]
+    kernels.stereo_to_mono(stereo, out)
 
     if not output_bytes:
-        return output
+        return out
     else:
-        return output.tobytes()
+        return out.tobytes()
+
 
+def mono_to_stereo(samples, output_bytes: bool = True, out: np.ndarray | None = None):
+    mono = as_int16(samples)
 
-def mono_to_stereo(samples: bytes):
-    output = b''
+    if out is None:
+        out = np.empty(len(mono) * 2, dtype=np.int16)
 
-    for i in range(0, len(samples), 2):
-        output += samples[i:i + 2] * 2
+    out = out[:len(mono) * 2]
+    kernels.mono_to_stereo(mono, out)
+
+    if not output_bytes:
+        return out
+    else:
+        return out.tobytes()
 
-    return output
 
+class FreeDVSource(discord.AudioSource, PipelineStage):
+    # 20 ms of 48 kHz stereo int16, exactly what discord expects from every read()
+    FRAME_SAMPLES = 1920
+    name = 'rx'
 
-class FreeDVSource(discord.AudioSource):
-    def __init__(self, q: queue.Queue, _freedv: freedv.FreeDV700D | None):
+    def __init__(self, rx_buffer: PCMRingBuffer, _freedv: freedv.FreeDV | freedv.MultiModeReceiver | None,
+                 target_ms: float = 100, recorder: QSORecorder | None = None, rate: int = 8000,
+                 labels: dict | None = None):
         super().__init__()
-        self.rx_queue = q
+        self.rx_buffer = rx_buffer
         self.fdv = _freedv
-
-        self.n_samples_per_read = 3840
-        self.audio_buffer = deque()
+        self.recorder = recorder
+        self.rate = rate
+
+        # the radio and discord run on different clocks, the jitter buffer keeps the delay between them constant
+        self.playout_buffer = JitterBuffer(48000, channels=2, target_ms=target_ms)
+        self.drift_corrector = DriftCorrector()
+        self.frame = np.empty(self.FRAME_SAMPLES, dtype=np.int16)
+        self.silence_frame = generate_silence(self.FRAME_SAMPLES)
+        self.rx_block = np.empty(1024, dtype=np.int16)
+        self.resamplers = {}
+
+        self.read_time = metrics.registry.histogram('discdv_source_read_seconds',
+                                                    'Time taken to hand discord one 20 ms frame', labels)
+        self.silent_reads = metrics.registry.counter('discdv_source_silent_reads_total',
+                                                     'Discord frames filled with silence because no audio was ready',
+                                                     labels)
 
         self.receive_freedv = True if self.fdv else False
 
-    def read(self) -> bytes:
-        output = b''
-        n_available_receive_samples = self.rx_queue.qsize()
+    def process(self):
+        n = self.rx_buffer.available()
+        if n == 0:
+            return
 
-        if self.fdv:
-            nin = self.fdv.get_nin() * 2
-        else:
-            nin = 2048  # don't know if the value of this really means much
+        if len(self.rx_block) < n:
+            self.rx_block = np.empty(n, dtype=np.int16)
 
-        if n_available_receive_samples > nin:
-            receive_samples = get_bytes_from_queue_nowait(self.rx_queue, nin)
-            if self.receive_freedv:
-                receive_samples = self.fdv.rx(receive_samples)
+        receive_samples = self.rx_buffer.read(n, out=self.rx_block)
+        rate = self.rate
 
-            output_samples = mono_to_stereo(
-                resampy.resample(np.frombuffer(receive_samples, dtype=np.int16),
-                                 8000, 48000).astype(np.int16).tobytes()
+        if self.receive_freedv:
+            # only the modem needs 8 kHz, a faster soundcard is decimated just for it
+            receive_samples = self.fdv.demodulate(self.resample(receive_samples, rate, self.fdv.modem_sample_rate))
+            rate = self.fdv.speech_sample_rate
+
+        if len(receive_samples):
+            if self.recorder:
+                self.recorder.rx(receive_samples, rate)
+
+            # drift correction is far cheaper on low rate mono than on the 48 kHz stereo it turns into
+            receive_samples = self.drift_corrector.process(receive_samples, self.playout_buffer.update_ratio())
+
+            self.playout_buffer.write(
+                mono_to_stereo(self.resample(receive_samples, rate, 48000), output_bytes=False),
+                stretch=False
             )
 
-            for sample in output_samples:
-                self.audio_buffer.append(sample.to_bytes(1))
+    def resample(self, samples: np.ndarray, in_rate: int, out_rate: int):
+        # analog audio from a 48 kHz soundcard goes straight through
+        if in_rate == out_rate:
+            return samples
+
+        # 2020 modes decode to 16 kHz speech, everything else is 8 kHz
+        resampler = self.resamplers.get((in_rate, out_rate))
+        if resampler is None:
+            resampler = self.resamplers[(in_rate, out_rate)] = StreamingResampler(in_rate, out_rate)
 
-        if len(self.audio_buffer) > self.n_samples_per_read:
-            for i in range(self.n_samples_per_read):
-                output += self.audio_buffer.popleft()
+        return resampler.process(samples)
+
+    def read(self) -> bytes:
+        start = time.perf_counter()
+
+        samples = self.playout_buffer.read(self.FRAME_SAMPLES, out=self.frame)
+
+        if samples is not None:
+            output = samples.tobytes()
         else:
-            output += b'\x00' * self.n_samples_per_read
+            output = self.silence_frame
+            self.silent_reads.inc()
 
+        self.read_time.observe(time.perf_counter() - start)
         return output
 
     def set_receive_freedv(self, value):
         self.receive_freedv = value if self.fdv else False
 
+        # the filter history belongs to the other path
+        self.resamplers.clear()
+
+
+class TXMixer:
+    # Sums every permitted speaker's jitter buffer into one int32 accumulator at 48 kHz, then resamples the mix once.
+    # All buffers are kept between calls and only reallocated when the frame size changes.
+    def __init__(self, silence_threshold: int = 0):
+        # a speaker whose peak sample is at or below this is treated as silent and left out of the mix
+        self.silence_threshold = silence_threshold
+        # a speaker who has sent nothing for this long has finished talking
+        self.tail_timeout = 0.1
+
+        self.mix = np.zeros(0, dtype=np.int32)
+        self.mix_int16 = np.zeros(0, dtype=np.int16)
+        self.stereo = np.zeros(0, dtype=np.int16)
+        self.gain_int16 = np.zeros(0, dtype=np.int16)
+        self.resamplers = {}
+
+        self.active_users = []
+        # speakers still talking who haven't sent a whole frame yet
+        self.waiting = 0
+        self.peak_level = 0
+        self.rms_level = 0.0
+
+    def is_silent(self, samples: np.ndarray):
+        # a single pass over the samples, nothing the size of the frame gets allocated
+        return kernels.peak(samples) <= self.silence_threshold
+
+    def mix_users(self, speakers: dict, user_ids, nsamples: int, rate: int):
+        # discord audio is 48 kHz stereo int16
+        nsamples_48k = nsamples * (48000 // rate)
+
+        if len(self.mix) != nsamples_48k:
+            self.mix = np.zeros(nsamples_48k, dtype=np.int32)
+            self.mix_int16 = np.zeros(nsamples_48k, dtype=np.int16)
+            self.stereo = np.zeros(nsamples_48k * 2, dtype=np.int16)
+        else:
+            self.mix.fill(0)
+
+        self.active_users.clear()
+        self.waiting = 0
+
+        for user_id, speaker in list(speakers.items()):
+            if user_id not in user_ids:
+                continue
+
+            # only audio that has actually arrived, a speaker who is behind sits this frame out
+            speaker.set_read_size(len(self.stereo))
+            stereo = speaker.read(len(self.stereo), out=self.stereo)
+            if stereo is None:
+                if speaker.idle() <= self.tail_timeout:
+                    self.waiting += 1
+                    continue
+
+                # they stopped talking, play the last of it now instead of at the start of their next over
+                stereo = speaker.drain(len(self.stereo), out=self.stereo)
+
+            if stereo is None or self.is_silent(stereo):
+                continue
+
+            # both channels go into the accumulator, like stereo_to_mono, without ever wrapping
+            kernels.mix_stereo(self.mix, stereo)
+
+            self.active_users.append(user_id)
+
+        if not self.active_users:
+            self.peak_level = 0
+            self.rms_level = 0.0
+            return None
 
-class FreeDVSink(discord.sinks.Sink):
-    def __init__(self, q: queue.Queue, record_user_ids, _freedv: freedv.FreeDV700D | None):
+        kernels.saturate(self.mix, self.mix_int16)
+        self.peak_level = kernels.peak(self.mix_int16)
+        self.rms_level = kernels.rms(self.mix_int16)
+
+        if rate == 48000:
+            return self.mix_int16
+
+        if rate not in self.resamplers:
+            self.resamplers[rate] = StreamingResampler(48000, rate)
+
+        return self.resamplers[rate].process(self.mix_int16)
+
+    def apply_gain(self, samples: np.ndarray, volume: int):
+        if volume == 100:
+            return samples
+
+        if len(self.gain_int16) != len(samples):
+            self.gain_int16 = np.zeros(len(samples), dtype=np.int16)
+
+        # Q15 fixed point, 100 % is 32768. the kernels multiply in int32, so a full scale sample times the gain has
+        # to stay below 2 ** 31, which caps the gain just short of 200 %
+        gain = min(max(volume, 0) * 32768 // 100, MAX_Q15_GAIN)
+        kernels.apply_gain_q15(samples, gain, self.gain_int16)
+
+        return self.gain_int16
+
+
+class FreeDVSink(discord.sinks.Sink, PipelineStage):
+    name = 'tx'
+
+    def __init__(self, tx_buffer: TXBuffer, record_user_ids, _freedv: freedv.FreeDV | None,
+                 recorder: QSORecorder | None = None, rate: int = 8000, speaker_target_ms: float = 100):
         super().__init__()
-        self.tx_queue = q
+        self.tx_buffer = tx_buffer
         self.record_user_ids = record_user_ids
+        # discord delivers each speaker in bursts on its own clock, they all get a jitter buffer of their own
+        self.speakers: dict[int, JitterBuffer] = {}
+        self.speaker_target_ms = speaker_target_ms
         self.fdv = _freedv
+        self.recorder = recorder
+        self.rate = rate
+        self.resampler = None
+        self.recording_tx = False
+        self.tx_session = 0
+        # frames mixed since the last soundcard block while the radio wasn't keyed, and the ones from before the
+        # TX gate keyed up, the recording starts with them
+        self.unkeyed_blocks = []
+        self.preroll = collections.deque(maxlen=64)
+        self.rms_level = 0.0
         self.tx_enabled = False
         self.ptt = False
+        self.keyed = False
+        self.silence = np.zeros(0, dtype=np.int16)
         self.tx_volume = 100
+        self.mixer = TXMixer()
 
         self.transmit_freedv = True if self.fdv else False
 
+    def write(self, data, user):
+        # called on discord's receive thread instead of collecting everyone into a file
+        if user not in self.record_user_ids:
+            return
+
+        speaker = self.speakers.get(user)
+        if speaker is None:
+            speaker = self.speakers[user] = JitterBuffer(48000, channels=2, target_ms=self.speaker_target_ms)
+
+        # pycord puts silence for the whole gap since their last packet in front of it. after a pause that long
+        # the gap is between two overs and would only delay the next one
+        samples = np.frombuffer(data, dtype=np.int16)
+        keep = FreeDVSource.FRAME_SAMPLES if speaker.idle() > self.mixer.tail_timeout else speaker.max_depth
+        speaker.write(samples[-keep:])
+
     def tx(self):
-        nsamples = self.fdv.get_n_speech_samples() * 2 if self.fdv else 2048  # don't know what to set this to
-        audios_int16 = []
+        if self.transmit_freedv:
+            nsamples = self.fdv.get_n_speech_samples()
+            rate = self.fdv.speech_sample_rate
+        else:
+            # 20 ms, the same as one discord packet
+            nsamples = self.rate // 50
+            rate = self.rate
 
-        for user_id, audio in self.audio_data.items():
-            if user_id not in self.record_user_ids:
-                continue
+        self.ptt = False
+        self.unkeyed_blocks.clear()
 
-            audio.file.seek(0)
+        if not self.tx_enabled:
+            # nowhere for the audio to go, one frame a block keeps the speakers from piling up
+            self.rms_level = 0.0
+            self.tx_frame(nsamples, rate)
 
-            audio_samples = audio.file.read(nsamples * 6 * 2)
+        # FreeDV frames don't line up with soundcard blocks, so run as many as it takes to keep the TX buffer at its
+        # target. a block that needs none keeps the last level for the TX gate
+        elif self.tx_buffer.available() < self.tx_buffer.target:
+            self.rms_level = 0.0
+            while self.tx_frame(nsamples, rate) and self.tx_buffer.available() < self.tx_buffer.target:
+                pass
 
-            audio.file.seek(0)
-            audio.file.truncate()
+        if self.recorder and not self.keyed:
+            self.record_tx(None, rate)
 
-            if len(audio_samples) < nsamples * 6 * 2:
-                audio_samples += b'\x00' * ((nsamples * 6 * 2) - len(audio_samples))
+        return self.ptt
 
-            audio_int16 = stereo_to_mono(audio_samples, output_bytes=False)
-            audio_int16 = resampy.resample(audio_int16, 48000, 8000).astype(np.int16)
+    def tx_frame(self, nsamples: int, rate: int):
+        output_audio = self.mixer.mix_users(self.speakers, self.record_user_ids, nsamples, rate)
 
-            if not np.array_equal(audio_int16, np.zeros(len(audio_int16), dtype=np.int16)):
-                audios_int16.append(audio_int16)
+        # nobody is talking but the TX gate is still hanging on, keep the modem running on silence
+        if output_audio is None and self.keyed and not self.mixer.waiting:
+            output_audio = self.get_silence(nsamples)
 
-        try:
-            output_len = len(audios_int16[0])
-            output_audio = np.zeros(output_len, dtype=np.int16)
+        if output_audio is None:
+            return False
 
-            for audio in audios_int16:
-                output_audio += audio
+        self.rms_level = max(self.rms_level, self.mixer.rms_level)
 
-            output_audio = output_audio.tobytes()
-            if self.tx_enabled:
-                tx_data = self.fdv.tx(output_audio) if self.transmit_freedv else output_audio
+        if self.recorder:
+            if self.keyed:
+                self.record_tx(output_audio, rate)
             else:
-                tx_data = None
+                # the mix buffers are reused for the next frame
+                self.unkeyed_blocks.append((output_audio.copy(), rate, tuple(self.mixer.active_users)))
 
-        except IndexError:
-            tx_data = None
+        if not self.tx_enabled:
+            return True
 
-        if tx_data:
-            tx_int16 = np.frombuffer(tx_data, dtype=np.int16) * (self.tx_volume / 100)
-            tx_data = tx_int16.tobytes()
+        tx_data = self.modulate(output_audio) if self.transmit_freedv else output_audio
+        if tx_data is None:
+            return False
 
-            for data in tx_data:
-                self.tx_queue.put(data)
+        self.tx_buffer.write(self.mixer.apply_gain(tx_data, self.tx_volume))
+        self.ptt = True
+        return True
 
-            self.ptt = True
+    def modulate(self, speech: np.ndarray):
+        modulated = self.fdv.tx(speech)
+        if modulated is None or self.fdv.modem_sample_rate == self.rate:
+            return modulated
 
-        else:
-            self.ptt = False
+        # 8 kHz modem audio up to whatever rate the soundcard runs at
+        resampler = self.resampler
+        if resampler is None or resampler.in_rate != self.fdv.modem_sample_rate:
+            resampler = self.resampler = StreamingResampler(self.fdv.modem_sample_rate, self.rate)
 
-        return self.ptt
+        return resampler.process(modulated)
+
+    def record_tx(self, samples: np.ndarray | None, rate: int):
+        # one recording per PTT session, the speech before it went through the modem
+        if samples is not None:
+            if not self.recording_tx:
+                self.tx_session += 1
+                self.recording_tx = True
+
+                for held, held_rate, user_ids in self.preroll:
+                    self.recorder.tx(held, held_rate, user_ids, self.tx_session)
+                self.preroll.clear()
+
+            self.recorder.tx(samples, rate, self.mixer.active_users, self.tx_session)
+
+        elif self.recording_tx:
+            self.recorder.end_tx()
+            self.recording_tx = False
+
+    def hold_preroll(self):
+        # called by the TX gate for every block of speech before it keys up
+        self.preroll.extend(self.unkeyed_blocks)
+
+    def clear_preroll(self):
+        self.preroll.clear()
+
+    def get_silence(self, nsamples: int):
+        if len(self.silence) != nsamples:
+            self.silence = np.zeros(nsamples, dtype=np.int16)
+
+        return self.silence
+
+    def process(self):
+        self.tx()
 
     def set_tx_volume(self, level: int):
         self.tx_volume = level
@@ -155,20 +400,9 @@ class FreeDVSink(discord.sinks.Sink):
 
     def cleanup(self):
         self.finished = True
-        for file in self.audio_data.values():
-            file.cleanup()
+        self.speakers.clear()
 
     def set_transmit_freedv(self, value):
         self.transmit_freedv = value if self.fdv else False
+        self.resampler = None
 
-
-def get_bytes_from_queue_nowait(q: queue.Queue, num_items: int):
-    output = b''
-    for i in range(num_items):
-        try:
-            byte = q.get_nowait()
-            output += byte
-        except queue.Empty:
-            break
-
-    return output
@@ -0,0 +1,355 @@
+# Offline benchmarks for the audio pipeline, no radio, soundcard or discord connection needed.
+#
+#   python benchmark.py                  run everything and compare against benchmark_baseline.json
+#   python benchmark.py --save-baseline  store this run as the new baseline
+#
+# A real libcodec2 in ./lib is used when it loads, otherwise a stub with the same interface stands in.
+
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+import tracemalloc
+import numpy as np
+import audio
+import freedv
+import kernels
+import rig_control
+from jitter import TXBuffer
+from ring_buffer import PCMRingBuffer
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+
+class StubFreeDV:
+    # stands in for freedv.FreeDV with 700D frame sizes and a trivial modem
+    def __init__(self, mode: str = '700D'):
+        self.mode = mode
+        self.speech_sample_rate = 8000
+        self.modem_sample_rate = 8000
+        self.n_speech_samples = 1280
+        self.nin = 1280
+        self.analog_listen = False
+
+        self.rx_input = PCMRingBuffer(8000 * 4)
+        self.rx_block = np.zeros(self.nin, dtype=np.int16)
+        self.speech_out = np.zeros(self.n_speech_samples, dtype=np.int16)
+        self.mod_out = np.zeros(self.n_speech_samples, dtype=np.int16)
+
+    def get_nin(self):
+        return self.nin
+
+    def get_n_speech_samples(self):
+        return self.n_speech_samples
+
+    def get_sync(self):
+        return 1
+
+    def listen_to_analog(self, val: bool):
+        self.analog_listen = val
+
+    def rx(self, demod_in: np.ndarray):
+        np.right_shift(demod_in, 1, out=self.speech_out)
+        return self.speech_out
+
+    def demodulate(self, samples: np.ndarray):
+        self.rx_input.write(samples)
+        speech = []
+
+        while self.rx_input.available() >= self.nin:
+            speech.append(self.rx(self.rx_input.read(self.nin, out=self.rx_block)).copy())
+
+        return np.concatenate(speech) if speech else self.speech_out[:0]
+
+    def tx(self, speech_in: np.ndarray):
+        np.copyto(self.mod_out, speech_in)
+        return self.mod_out
+
+    def close(self):
+        pass
+
+
+class FakeRigctldHandler(socketserver.StreamRequestHandler):
+    # replies to a pipelined batch go out as separate small writes, don't let nagle hold them back
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        state = self.server.state
+
+        for line in self.rfile:
+            command = line.decode().split()
+            if not command:
+                continue
+
+            if command[0] == 'f':
+                reply = f'{state["freq"]}\n'
+            elif command[0] == 'm':
+                reply = f'{state["mode"]}\n2400\n'
+            elif command[0] == 't':
+                reply = f'{state["ptt"]}\n'
+            elif command[0] == 'F':
+                state['freq'] = int(command[1])
+                reply = 'RPRT 0\n'
+            elif command[0] == 'M':
+                state['mode'] = command[1]
+                reply = 'RPRT 0\n'
+            elif command[0] == 'T':
+                state['ptt'] = int(command[1])
+                reply = 'RPRT 0\n'
+            else:
+                reply = 'RPRT -1\n'
+
+            self.wfile.write(reply.encode())
+
+
+class FakeRigctld(socketserver.ThreadingTCPServer):
+    # just enough of the rigctld protocol for RigControl, listening on the usual port
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port: int = 4532):
+        super().__init__(('localhost', port), FakeRigctldHandler)
+        self.state = {'freq': 14236000, 'mode': 'USB', 'ptt': 0}
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def load_codec(use_stub: bool):
+    if not use_stub:
+        try:
+            return freedv.FreeDV('700D')
+        except Exception as e:
+            print(f'libcodec2 unavailable ({e}), using the stub codec')
+
+    return StubFreeDV()
+
+
+def synthetic_voice(nsamples: int, rate: int, seed: int):
+    # a couple of harmonics with a slow envelope is close enough to speech for throughput purposes
+    rng = np.random.default_rng(seed)
+    t = np.arange(nsamples) / rate
+    f0 = rng.uniform(90, 250)
+    signal = np.sin(2 * np.pi * f0 * t) + 0.5 * np.sin(2 * np.pi * 3 * f0 * t)
+    signal *= 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+    return (signal * 8000 + rng.normal(0, 200, nsamples)).astype(np.int16)
+
+
+def measure(name: str, step, frames: int, frame_duration: float | None, warmup: int = 20):
+    for i in range(warmup):
+        step()
+
+    times = np.empty(frames)
+    alloc_peaks = np.empty(frames)
+    tracemalloc.start()
+
+    for i in range(frames):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        step()
+        times[i] = time.perf_counter() - start
+
+        alloc_peaks[i] = tracemalloc.get_traced_memory()[1] - current
+
+    tracemalloc.stop()
+
+    # tracing slows allocation down, so timings come from a second untraced run
+    for i in range(frames):
+        start = time.perf_counter()
+        step()
+        times[i] = time.perf_counter() - start
+
+    result = {
+        'p50_ms': float(np.percentile(times, 50) * 1000),
+        'p95_ms': float(np.percentile(times, 95) * 1000),
+        'p99_ms': float(np.percentile(times, 99) * 1000),
+        'max_ms': float(times.max() * 1000),
+        'alloc_kib_per_frame': float(alloc_peaks.mean() / 1024),
+        'realtime_x': float(frame_duration / times.mean()) if frame_duration else None,
+    }
+
+    return name, result
+
+
+def bench_conversions(frames: int):
+    stereo = audio.mono_to_stereo(synthetic_voice(960, 48000, 0))
+    mono = synthetic_voice(960, 48000, 1)
+    mono_out = np.empty(960, dtype=np.int16)
+    stereo_out = np.empty(1920, dtype=np.int16)
+
+    yield measure('stereo_to_mono', lambda: audio.stereo_to_mono(stereo), frames, 0.02)
+    yield measure('stereo_to_mono (out buffer)',
+                  lambda: audio.stereo_to_mono(stereo, output_bytes=False, out=mono_out), frames, 0.02)
+    yield measure('mono_to_stereo', lambda: audio.mono_to_stereo(mono), frames, 0.02)
+    yield measure('mono_to_stereo (out buffer)',
+                  lambda: audio.mono_to_stereo(mono, output_bytes=False, out=stereo_out), frames, 0.02)
+
+
+def bench_ring_buffer(frames: int):
+    # the ring buffer replaced get_bytes_from_queue_nowait, this is the same 1024 sample block move
+    ring = PCMRingBuffer(8000 * 4)
+    block = synthetic_voice(1024, 8000, 2)
+    out = np.empty(1024, dtype=np.int16)
+
+    def step():
+        ring.write(block)
+        ring.read(1024, out=out)
+
+    yield measure('ring buffer 1024 samples', step, frames, 1024 / 8000)
+
+
+def bench_sink(frames: int, users: int, codec, transmit_freedv: bool, soundcard_rate: int = 8000):
+    sink = audio.FreeDVSink(TXBuffer(soundcard_rate, 300), {user_id: None for user_id in range(users)}, codec,
+                            rate=soundcard_rate)
+    sink.set_transmit_freedv(transmit_freedv)
+    sink.enable_tx(True)
+
+    if sink.transmit_freedv:
+        nsamples, rate = codec.get_n_speech_samples(), codec.speech_sample_rate
+    else:
+        nsamples, rate = 1024 * soundcard_rate // 8000, soundcard_rate
+
+    nsamples_48k = nsamples * (48000 // rate)
+    voices = [audio.mono_to_stereo(synthetic_voice(nsamples_48k, 48000, user_id)) for user_id in range(users)]
+
+    def step():
+        # what discord's receive thread would have written since the last block
+        for user_id, voice in enumerate(voices):
+            sink.write(voice, user_id)
+
+        sink.tx()
+        sink.tx_buffer.clear()
+
+    mode = 'freedv' if sink.transmit_freedv else 'analog'
+    suffix = '' if soundcard_rate == 8000 else f' {soundcard_rate // 1000}k'
+    yield measure(f'FreeDVSink.tx {users} users {mode}{suffix}', step, frames, nsamples / rate)
+
+
+def bench_source(frames: int, codec, receive_freedv: bool, soundcard_rate: int = 8000):
+    rx_buffer = PCMRingBuffer(soundcard_rate * 4)
+    source = audio.FreeDVSource(rx_buffer, codec, rate=soundcard_rate)
+    source.set_receive_freedv(receive_freedv)
+    block = synthetic_voice(1024 * soundcard_rate // 8000, soundcard_rate, 3)
+    frames_due = [0.0]
+
+    def step():
+        # one soundcard block in, then the 6.4 discord frames it is worth out
+        rx_buffer.write(block)
+        source.process()
+
+        frames_due[0] += 1024 / 8000 / 0.02
+        while frames_due[0] >= 1:
+            source.read()
+            frames_due[0] -= 1
+
+    mode = 'freedv' if source.receive_freedv else 'analog'
+    suffix = '' if soundcard_rate == 8000 else f' {soundcard_rate // 1000}k'
+    yield measure(f'FreeDVSource.process + read {mode}{suffix}', step, frames, 1024 / 8000)
+
+
+def bench_rig(frames: int, port: int):
+    server = FakeRigctld(port)
+    rig = rig_control.RigControl(None, port)
+
+    try:
+        yield measure('RigControl.get_freq', rig.get_freq, frames, None)
+        yield measure('RigControl.set_ptt', lambda: rig.set_ptt(False), frames, None)
+        yield measure('RigClient pipeline f/m/t', lambda: rig.run(rig.client.pipeline('f', 'm', 't')), frames, None)
+    finally:
+        rig.close()
+        server.close()
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        if result['p95_ms'] > baseline[name]['p95_ms'] * tolerance:
+            regressions.append(f'{name}: p95 {result["p95_ms"]:.3f} ms vs baseline {baseline[name]["p95_ms"]:.3f} ms')
+
+        if result['alloc_kib_per_frame'] > baseline[name]['alloc_kib_per_frame'] * tolerance + 1:
+            regressions.append(f'{name}: {result["alloc_kib_per_frame"]:.1f} KiB allocated per frame vs baseline '
+                               f'{baseline[name]["alloc_kib_per_frame"]:.1f} KiB')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DiscDV audio pipeline offline')
+    parser.add_argument('--frames', type=int, default=500, help='frames measured per benchmark')
+    parser.add_argument('--users', type=int, default=4, help='simultaneous discord speakers for the sink benchmark')
+    parser.add_argument('--stub-codec', action='store_true', help='use the stub codec even if libcodec2 loads')
+    parser.add_argument('--rig-port', type=int, default=4532, help='port for the fake rigctld')
+    parser.add_argument('--no-rig', action='store_true', help='skip the rigctld round trip benchmarks')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed slowdown before flagging')
+    args = parser.parse_args()
+
+    codec = load_codec(args.stub_codec)
+    print(f'DSP kernels: {"numba" if kernels.HAVE_NUMBA else "numpy fallback"}')
+    kernels.warm_up()
+
+    benchmarks = [
+        bench_conversions(args.frames),
+        bench_ring_buffer(args.frames),
+        bench_sink(args.frames, args.users, codec, False),
+        bench_sink(args.frames, args.users, codec, True),
+        bench_source(args.frames, codec, False),
+        bench_source(args.frames, codec, True),
+        bench_sink(args.frames, args.users, codec, False, 48000),
+        bench_sink(args.frames, args.users, codec, True, 48000),
+        bench_source(args.frames, codec, False, 48000),
+        bench_source(args.frames, codec, True, 48000),
+    ]
+
+    if not args.no_rig:
+        benchmarks.append(bench_rig(args.frames, args.rig_port))
+
+    results = {}
+    print(f'{"benchmark":<40} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8} {"KiB/frame":>10} {"x realtime":>11}')
+
+    for benchmark in benchmarks:
+        for name, result in benchmark:
+            results[name] = result
+            realtime = f'{result["realtime_x"]:.1f}' if result['realtime_x'] else '-'
+            print(f'{name:<40} {result["p50_ms"]:>8.3f} {result["p95_ms"]:>8.3f} {result["p99_ms"]:>8.3f} '
+                  f'{result["max_ms"]:>8.3f} {result["alloc_kib_per_frame"]:>10.1f} {realtime:>11}')
+
+    codec.close()
+
+    if args.save_baseline:
+        with open(args.baseline, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+        print(f'Saved baseline to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create one')
+        return
+
+    with open(args.baseline, 'rt') as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+
+    if regressions:
+        print('Regressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+
+        raise SystemExit(1)
+
+    print('No regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
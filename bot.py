@@ -1,11 +1,15 @@
+import asyncio
 import discord
 import database
 import freedv
 import pyaudio
 import config
-import rig_control
-import audio
-import queue
+import kernels
+import metrics
+from station import Station, load_station_settings
+from startup import Startup
+from telemetry import ModemTelemetry, SHADES, render_spectrum
+from user_cache import UserNameCache
 
 try:
     TOKEN = open('token.txt', 'rt').read()
@@ -16,74 +20,70 @@ except Exception as e:
 print('Loading Discord modules...')
 
 bot = discord.Bot()
-bot_db = database.BotDatabase('operators.db')
-vc: discord.VoiceClient | None = None
-vc_sink: audio.FreeDVSink | None = None
-vc_source: audio.FreeDVSource | None = None
+bot_db: database.BotDatabase | None = None
+user_names = UserNameCache(bot)
+OPERATORS_PER_PAGE = 20
 
-print('Loading FreeDV...')
-try:
-    fdv = freedv.FreeDV700D()
-except Exception as e:
-    print('Error loading FreeDV! Make sure all codec2 .dll / .so files are built correctly and in the lib directory.')
-    print('Continuing to start without FreeDV capability! This may cause bugs!')
-    fdv = None
-    # raise e
+pa: pyaudio.PyAudio | None = None
+metrics_server = None
 
-print('Loading rigctld...')
-try:
-    rigctld = rig_control.RigControl(config.rigctld_cmd)
-except Exception as e:
-    print('Error loading rigctld! Ensure the rigctld_command in config.py is correct.')
-    raise e
+# one station per radio, each with its own rigctld, soundcard, codec and DSP thread. nothing is started
+# until start(), but the names are needed now for the rig option on the slash commands
+stations: dict[str, Station] = {name: Station(name, settings) for name, settings in load_station_settings().items()}
 
-rigctld.set_mode(config.default_mode, -1)
-rigctld.set_freq(config.default_freq * 1000)
 
-rx_queue = queue.Queue()
-tx_queue = queue.Queue()
-ptt = False
+def start_station(startup: Startup, station: Station):
+    # the codec, rigctld and soundcard start in parallel, the station ties them together once all are up
+    for part in ('codec', 'rigctld', 'audio'):
+        startup.result(f'{station.name}/{part}')
 
+    station.start(startup.result('database'))
 
-def pa_callback(in_data, frame_count, time_info, status):
-    global rx_queue, tx_queue, ptt
 
-    tx_mod = b'\x00\x00' * frame_count
-    if vc_sink is not None:
-        for data in in_data:
-            rx_queue.put(data.to_bytes(1))
+def start():
+    global bot_db, pa, metrics_server
 
-        new_ptt = vc_sink.tx()
+    # everything that doesn't depend on something else starts at the same time
+    startup = Startup()
+    startup.add('database', lambda: database.BotDatabase('operators.db'), lambda db: db.close())
+    startup.add('kernels', kernels.warm_up)
+    startup.add('pyaudio', pyaudio.PyAudio, lambda p: p.terminate())
 
-        if new_ptt and not ptt:
-            ptt = True
-            rigctld.set_ptt(ptt)
+    for station in stations.values():
+        # close() copes with a station that only partly started
+        stop = lambda value, s=station: s.close()
 
-        elif ptt and not new_ptt:
-            ptt = False
-            rigctld.set_ptt(ptt)
+        startup.add(f'{station.name}/codec', station.load_codec, stop)
+        startup.add(f'{station.name}/rigctld', station.start_rig, stop)
+        startup.add(f'{station.name}/audio', lambda s=station: s.start_audio(startup.result('pyaudio')), stop)
+        startup.add(station.name, lambda s=station: start_station(startup, s), stop)
 
-        if tx_queue.qsize() > frame_count * 2:
-            tx_mod = audio.get_bytes_from_queue_nowait(tx_queue, frame_count * 2)
+    started = startup.run()
+    bot_db = started['database']
+    pa = started['pyaudio']
 
-    return tx_mod, pyaudio.paContinue
+    if config.metrics_port:
+        metrics_server = metrics.serve(config.metrics_port)
+        print(f'Serving metrics on http://127.0.0.1:{config.metrics_port}/metrics')
 
 
-pa = pyaudio.PyAudio()
-tx_volume = config.tx_volume
+def rig_option():
+    return discord.Option(str, 'Which radio to use', choices=list(stations), required=False, default=None)
 
-input_device_name = pa.get_device_info_by_index(config.audio_input_device)['name']
-output_device_name = pa.get_device_info_by_index(config.audio_output_device)['name']
 
-print(f'Starting audio using input device [{input_device_name}] and output device [{output_device_name}]')
-try:
-    af_stream = pa.open(rate=8000, channels=1, format=pyaudio.paInt16, input=True, output=True, frames_per_buffer=1024,
-                        stream_callback=pa_callback,
-                        input_device_index=config.audio_input_device,
-                        output_device_index=config.audio_output_device)
-except Exception as e:
-    print('Error starting audio! Ensure the input and output devices are correctly configured in config.py')
-    raise e
+def get_station(ctx: discord.ApplicationContext, rig: str | None):
+    if rig:
+        return stations.get(rig)
+
+    if len(stations) == 1:
+        return next(iter(stations.values()))
+
+    # with no rig given, use the one connected to a voice channel in this server
+    for station in stations.values():
+        if station.vc and station.vc.guild == ctx.guild:
+            return station
+
+    return None
 
 
 @bot.event
@@ -96,25 +96,159 @@ async def ping(ctx):
     await ctx.respond(f'Current bot ping is: {round(bot.latency, 5)}')
 
 
+@bot.slash_command(name='stats', description='Get audio pipeline latency and health statistics')
+async def stats(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    lines = [str(stage_stats) for stage_stats in station.pipeline.get_stats()] + metrics.registry.summary()
+    message = '\n'.join(lines)
+
+    # discord messages are capped at 2000 characters
+    if len(message) > 1900:
+        message = message[:1900] + '\n...'
+
+    await ctx.respond(f'```\n{message}\n```')
+
+
 @bot.slash_command(name='analog_listen', description='Set whether the radio will play audio when not synced')
-async def set_analog_listen(ctx: discord.ApplicationContext, value: bool):
-    if not fdv:
+async def set_analog_listen(ctx: discord.ApplicationContext, value: bool, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    if not station.fdv:
         await ctx.respond('FreeDV mode is not supported!')
         return
 
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
-        fdv.listen_to_analog(value)
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
+        # an out of process modem waits for the child to answer, so not on discord's event loop
+        await asyncio.to_thread(station.fdv.listen_to_analog, value)
+        await asyncio.to_thread(station.rx_fdv.listen_to_analog, value)
         await ctx.respond(f'Analog listen is now set to: {value}')
 
     else:
         await ctx.respond('You are not permitted to run this command!')
 
 
+@bot.slash_command(name='set_freedv_mode', description='Change the FreeDV mode used to transmit and receive')
+async def set_freedv_mode(ctx: discord.ApplicationContext,
+                          mode: discord.Option(str, choices=list(freedv.FREEDV_MODES)), rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    if not station.fdv:
+        await ctx.respond('FreeDV mode is not supported!')
+        return
+
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
+        try:
+            await asyncio.to_thread(station.fdv.set_mode, mode)
+        except ValueError as e:
+            await ctx.respond(str(e))
+            return
+
+        if station.rx_fdv is not station.fdv:
+            await ctx.respond(f'FreeDV transmit mode is now set to: {mode}, '
+                              f'receive follows {", ".join(station.settings["freedv_rx_modes"])}')
+        else:
+            await ctx.respond(f'FreeDV mode is now set to: {mode}')
+
+    else:
+        await ctx.respond('You are not permitted to run this command!')
+
+
+@bot.slash_command(name='rx_stats', description='Get sync and CPU statistics for each FreeDV receive mode')
+async def rx_stats(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    if not isinstance(station.rx_fdv, freedv.MultiModeReceiver):
+        await ctx.respond('Multi-mode receive is not enabled!')
+        return
+
+    await ctx.respond('\n'.join(station.rx_fdv.get_stats()))
+
+
+def format_modem_status(mode: str, summary: dict, minutes: float):
+    lines = [f'{mode}: {"synced" if summary["sync"] else "no sync"}, SNR {summary["snr"]:.1f} dB']
+
+    if summary['snr_mean'] is not None:
+        lines.append(f'Synced {summary["sync_percent"]:.0f} % of the last {minutes:g} min, SNR while synced '
+                     f'{summary["snr_mean"]:.1f} dB ({summary["snr_min"]:.1f} .. {summary["snr_max"]:.1f})')
+    else:
+        lines.append(f'No sync in the last {minutes:g} min')
+
+    # libcodec2 reports the clock offset as a fraction
+    lines.append(f'Freq offset {summary["foff"]:+.1f} Hz, clock offset {summary["clock_offset"] * 1e6:+.0f} ppm, '
+                 f'sync quality {summary["sync_metric"]:.2f}')
+
+    if summary['frames']:
+        lines.append(f'{summary["frames"]} frames, {summary["frame_errors"]} with uncorrected errors '
+                     f'({100 * summary["frame_errors"] / summary["frames"]:.1f} %)')
+
+    return lines
+
+
+def modem_spectrum(telemetry: ModemTelemetry):
+    # a few milliseconds of FFTs, run on a worker thread rather than discord's event loop
+    spectrum = telemetry.spectrum()
+    waterfall = telemetry.spectrum(rows=8)
+    if spectrum is None or waterfall is None:
+        return ['Not enough audio for a spectrum yet']
+
+    return [f'Spectrum 0 .. {telemetry.rate // 2} Hz', *render_spectrum(spectrum),
+            'Waterfall, newest at the bottom', *render_spectrum(waterfall, chars=SHADES)]
+
+
+@bot.slash_command(name='modem_status', description='Get FreeDV modem SNR, sync and frequency offset over time')
+async def modem_status(ctx: discord.ApplicationContext,
+                       minutes: discord.Option(float, 'How far back to look', min_value=0.1, max_value=10,
+                                               default=1.0),
+                       spectrum: discord.Option(bool, 'Include a spectrum and waterfall of the received audio',
+                                                default=False),
+                       rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    if not station.rx_fdv:
+        await ctx.respond('FreeDV mode is not supported!')
+        return
+
+    telemetry = station.rx_fdv.telemetry
+    summary = telemetry.summary(minutes * 60)
+
+    # nothing is sampled while no audio from the radio goes through the modem
+    if summary is None or summary['age'] > 5 * telemetry.interval:
+        await ctx.respond('The modem is idle, the bot is in analog mode or not in a voice channel')
+        return
+
+    lines = format_modem_status(station.rx_fdv.mode, summary, minutes)
+    if spectrum:
+        lines += [''] + await asyncio.to_thread(modem_spectrum, telemetry)
+
+    await ctx.respond('```\n' + '\n'.join(lines) + '\n```')
+
+
 @bot.slash_command(name='add_operator', description='Add a user to be able to use the radio')
 async def add_operator(ctx: discord.ApplicationContext,
                        user: discord.Member, callsign: str, admin: bool):
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
-        bot_db.add_operator(user.id, callsign, admin)
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
+        try:
+            bot_db.add_operator(user.id, callsign, admin)
+        except ValueError as e:
+            await ctx.respond(str(e))
+            return
+
         await ctx.respond(f'{user.name} has been added as an operator!')
 
     else:
@@ -123,7 +257,7 @@ async def add_operator(ctx: discord.ApplicationContext,
 
 @bot.slash_command(name='remove_operator', description='Remove a users ability to operate the radio')
 async def remove_operator(ctx: discord.ApplicationContext, user: discord.Member):
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
         bot_db.delete_operator(user.id)
         await ctx.respond(f'{user.name} can no longer operate the radio!')
 
@@ -133,16 +267,27 @@ async def remove_operator(ctx: discord.ApplicationContext, user: discord.Member)
 
 @bot.slash_command(name='get_operators', description='Get all users that are able to operate the radio')
 async def get_operators(ctx: discord.ApplicationContext):
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
-        operators = bot_db.get_operators()
-        message = 'All operators: '
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
+        # looking up names can take longer than discord waits for a response
+        await ctx.defer()
+
+        operators = sorted(bot_db.get_operators(), key=lambda operator: operator.callsign)
+        if not operators:
+            await ctx.followup.send('There are no operators yet!')
+            return
 
-        for operator in operators:
-            user = await bot.fetch_user(operator.uuid)
-            username = user.name
-            message += f'{username} ({operator.callsign}), '
+        names = await user_names.resolve([operator.uuid for operator in operators], ctx.guild)
+        lines = [f'**{operator.callsign}** {names[operator.uuid]}{" (admin)" if operator.admin else ""}'
+                 for operator in operators]
 
-        await ctx.respond(message)
+        pages = [lines[i:i + OPERATORS_PER_PAGE] for i in range(0, len(lines), OPERATORS_PER_PAGE)]
+        embeds = [discord.Embed(title=f'Operators ({len(operators)})' if i == 0 else None, description='\n'.join(page))
+                  .set_footer(text=f'Page {i + 1} of {len(pages)}')
+                  for i, page in enumerate(pages)]
+
+        # discord takes at most 10 embeds per message
+        for i in range(0, len(embeds), 10):
+            await ctx.followup.send(embeds=embeds[i:i + 10])
 
     else:
         await ctx.respond('You are not permitted to run this command!')
@@ -150,8 +295,12 @@ async def get_operators(ctx: discord.ApplicationContext):
 
 @bot.slash_command(name='get_operator_info', description='Get info about a users ability to operate the radio')
 async def get_operator_info(ctx: discord.ApplicationContext, user: discord.Member):
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
         operator = bot_db.get_operator(user.id)
+        if operator is None:
+            await ctx.respond(f'{user.name} is not an operator!')
+            return
+
         await ctx.respond(f'Name: {user.name}, Callsign: {operator.callsign}, Admin? {bool(operator.admin)}')
 
     else:
@@ -159,10 +308,15 @@ async def get_operator_info(ctx: discord.ApplicationContext, user: discord.Membe
 
 
 @bot.slash_command(name='enable_tx', description='Enable radio transmit')
-async def enable_tx(ctx: discord.ApplicationContext):
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
-        if vc:
-            vc_sink.enable_tx(True)
+async def enable_tx(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
+        if station.vc:
+            station.sink.enable_tx(True)
             await ctx.respond('TX is now enabled! '
                               'If you are permitted to operate the radio, '
                               'speaking in VC will trigger radio transmit!')
@@ -173,10 +327,15 @@ async def enable_tx(ctx: discord.ApplicationContext):
 
 
 @bot.slash_command(name='disable_tx', description='Disable radio transmit')
-async def disable_tx(ctx: discord.ApplicationContext):
-    if ctx.author.guild_permissions.administrator or bot_db.get_operator(ctx.author.id).admin:
-        if vc:
-            vc_sink.enable_tx(False)
+async def disable_tx(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    if ctx.author.guild_permissions.administrator or bot_db.is_admin(ctx.author.id):
+        if station.vc:
+            station.sink.enable_tx(False)
             await ctx.respond('TX is now disabled! Speaking in VC will no longer trigger radio transmit.')
         else:
             await ctx.respond('The bot is not currently connected to a voice channel.')
@@ -184,126 +343,157 @@ async def disable_tx(ctx: discord.ApplicationContext):
         await ctx.respond('You are not permitted to run this command!')
 
 
-async def on_voice_leave(sink: discord.sinks, channel: discord.TextChannel, *args):
-    await sink.vc.disconnect()
-
-
 @bot.slash_command(name='join', description='Make the bot join a voice channel to use the radio!')
-async def join_voice_channel(ctx: discord.ApplicationContext):
-    global vc, vc_sink, vc_source, rx_queue, tx_queue, fdv
+async def join_voice_channel(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
 
-    if vc:
+    if station.vc:
         await ctx.respond('Bot is already in a voice channel!')
         return
 
-    voice = ctx.author.voice
-    vc_sink = audio.FreeDVSink(tx_queue, [operator.uuid for operator in bot_db.get_operators()], fdv)
-    vc_sink.set_tx_volume(tx_volume)
-    vc_source = audio.FreeDVSource(rx_queue, fdv)
+    # discord only allows one voice connection per server, other radios have to join in other servers
+    if ctx.guild and ctx.guild.voice_client:
+        await ctx.respond('Another radio is already in a voice channel in this server!')
+        return
 
+    voice = ctx.author.voice
     if not voice:
         await ctx.respond('You are not in a voice channel!')
         return
 
-    vc = await voice.channel.connect()
-
-    vc.start_recording(
-        vc_sink,
-        on_voice_leave,
-        ctx.channel
-    )
-
-    vc.play(
-        vc_source,
-        wait_finish=False
-    )
+    await station.join(voice.channel, ctx.channel)
 
     await ctx.respond('Joined!')
 
 
 @bot.slash_command(name='leave', description='Make the bot leave the voice channel')
-async def leave_voice_channel(ctx: discord.ApplicationContext):
-    global vc, vc_sink, vc_source
+async def leave_voice_channel(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
 
-    if not vc:
+    if not station.vc:
         await ctx.respond('The bot is not currently in a voice channel!')
         return
 
-    assert isinstance(vc, discord.VoiceClient)
-
-    vc.stop()
-    await vc.disconnect()
-    vc = None
-    vc_sink = None
-    vc_source = None
+    await station.leave()
 
     await ctx.respond('Left the voice channel!')
 
 
 @bot.slash_command(name='set_freq', description='Set the frequency')
-async def set_freq(ctx: discord.ApplicationContext, freq: float):
-    operator_ids = [operator.uuid for operator in bot_db.get_operators()]
-    if ctx.author.id not in operator_ids and not ctx.author.guild_permissions.administrator:
+async def set_freq(ctx: discord.ApplicationContext, freq: float, rig: rig_option()):
+    if not bot_db.is_operator(ctx.author.id) and not ctx.author.guild_permissions.administrator:
         await ctx.respond('You are not permitted to run this command!')
         return
 
-    rigctld.set_freq(int(freq * 1000))
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    await station.rig.set_freq_async(int(freq * 1000))
     await ctx.respond(f'Radio VFO set to: {freq} KHz')
 
 
 @bot.slash_command(name='get_freq', description='Get the current frequency')
-async def get_freq(ctx: discord.ApplicationContext):
-    freq = rigctld.get_freq()
-    await ctx.respond(f'Current VFO: {freq / 1000} KHz')
+async def get_freq(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    # served from the polled rig state, never from the CAT link
+    state = station.rig.state
+    if state.freq is None:
+        await ctx.respond('The radio frequency is not known yet!')
+        return
+
+    await ctx.respond(f'Current VFO: {state.freq / 1000} KHz (as of {state.age():.1f} s ago)')
 
 
 @bot.slash_command(name='set_mode', description='Set the radio modulation mode')
-async def set_mode(ctx: discord.ApplicationContext, mode: str):
-    rigctld.set_mode(mode, -1)
+async def set_mode(ctx: discord.ApplicationContext, mode: str, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    await station.rig.set_mode_async(mode, -1)
     await ctx.respond(f'Radio set to: {mode}')
 
 
 @bot.slash_command(name='get_mode', description='Get the current radio modulation mode')
-async def get_mode(ctx: discord.ApplicationContext):
-    mode = rigctld.get_mode()
-    await ctx.respond(f'The radio is currently set to: {mode}')
+async def get_mode(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    state = station.rig.state
+    if state.mode is None:
+        await ctx.respond('The radio mode is not known yet!')
+        return
+
+    await ctx.respond(f'The radio is currently set to: {state.mode} (as of {state.age():.1f} s ago)')
 
 
 @bot.slash_command(name='analog_mode', description='Set the radio to transmit and receive in analog mode')
-async def analog_mode(ctx: discord.ApplicationContext):
-    global vc_sink, vc_source
-    vc_sink.set_transmit_freedv(False)
-    vc_source.set_receive_freedv(False)
+async def analog_mode(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    station.set_freedv(False)
     await ctx.respond('Set radio mode to analog')
 
 
 @bot.slash_command(name='freedv_mode', description='Set the radio to transmit and receive in FreeDV mode')
-async def freedv_mode(ctx: discord.ApplicationContext):
-    global vc_sink, vc_source
-    vc_sink.set_transmit_freedv(True)
-    vc_source.set_receive_freedv(True)
+async def freedv_mode(ctx: discord.ApplicationContext, rig: rig_option()):
+    station = get_station(ctx, rig)
+    if not station:
+        await ctx.respond('Pick a radio with the rig option!')
+        return
+
+    station.set_freedv(True)
     await ctx.respond('Set radio mode to FreeDV')
 
 
 def cleanup_all():
-    global fdv, rigctld, bot_db, af_stream, pa
+    global bot_db, pa, metrics_server
     print('Cleaning everything up...')
 
-    if fdv:
-        fdv.close()
+    # one component failing to close shouldn't leave the rest running
+    components = [('metrics server', metrics_server.shutdown if metrics_server else None)]
+    components += [(f'station {station.name}', station.close) for station in stations.values()]
+    components += [('database', bot_db.close if bot_db else None), ('PyAudio', pa.terminate if pa else None)]
+
+    for name, close in components:
+        if close is None:
+            continue
+
+        try:
+            close()
+        except Exception as e:
+            print(f'Error closing {name}: {e}')
 
-    rigctld.close()
-    bot_db.close()
-    af_stream.close()
-    pa.terminate()
     print('ALl closed successfully!')
 
 
 def main():
     global bot
     print('Starting bot...')
-    bot.run(TOKEN)
-    cleanup_all()
+    start()
+
+    try:
+        bot.run(TOKEN)
+    finally:
+        cleanup_all()
 
 
 if __name__ == '__main__':
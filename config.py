@@ -3,6 +3,25 @@
 audio_input_device = 0
 audio_output_device = 0
 tx_volume = 100
+soundcard_rate = 8000  # 8000, or 48000 to pass analog audio straight through and only resample for FreeDV
+rx_jitter_target_ms = 100  # audio held back before playing into discord, absorbs clock drift and late modem frames
+tx_jitter_target_ms = 300  # audio held back before transmitting, at least one 128 ms soundcard block plus one
+# FreeDV frame (160 ms for 700D and 700E)
+tx_speaker_jitter_ms = 100  # audio held back per speaker in VC before mixing, absorbs discord's network jitter
+
+# TX gate, decides when to key the radio from the level of the speakers in VC
+tx_vad_threshold_db = -45  # RMS level in dBFS that counts as speech, raise it if background noise keys the radio
+tx_attack_ms = 50  # speech has to last this long to key up, keep it below tx_jitter_target_ms so nothing is cut off
+tx_hang_ms = 1000  # stay keyed this long after the last speech, keep it above tx_jitter_target_ms
+tx_min_key_ms = 1000  # never unkey sooner than this after keying up
+
+# FreeDV configuration
+
+freedv_mode = '700D'  # 1600, 700C, 700D, 700E, 2020 or 2020B (2020 modes need a libcodec2 built with LPCNet),
+# or None for analog only without loading libcodec2
+freedv_rx_modes = []  # e.g. ['700D', '700E'] to decode several modes at once and play whichever one syncs
+modem_process = False  # run the FreeDV modem in a separate process, restarted automatically if it crashes,
+# with freedv_rx_modes every receive mode gets its own process too
 
 # Rig configuration
 
@@ -12,6 +31,29 @@ tx_volume = 100
 rigctld_cmd = ""  # put your rigctld command here
 default_freq = 14236  # KHz
 default_mode = 'USB'  # USB or LSB
+rig_poll_interval = 2.0  # seconds between background frequency / mode / PTT reads
+rigctld_start_timeout = 10.0  # seconds to wait for rigctld to start listening before giving up
+
+# More than one radio: give each one a name and the settings that differ from the ones above, every rig needs its
+# own rigctld port (and a matching -t in its rigctld_cmd) and its own soundcard. Slash commands take a rig option.
+# Discord only allows one voice connection per server, so radios that are on air together need separate servers.
+# rigs = {
+#     'hf': {'rigctld_cmd': 'rigctld -m 3073 -r /dev/ttyUSB0 -t 4532', 'rigctld_port': 4532,
+#            'audio_input_device': 1, 'audio_output_device': 1},
+#     'vhf': {'rigctld_cmd': 'rigctld -m 1035 -r /dev/ttyUSB1 -t 4533', 'rigctld_port': 4533,
+#             'audio_input_device': 2, 'audio_output_device': 2, 'default_freq': 145500, 'default_mode': 'FM'},
+# }
+rigs = {}
+
+# Recording configuration
+
+recording_dir = None  # e.g. 'recordings' to record everything heard and transmitted, None to turn recording off
+recording_format = 'wav'  # wav, flac or opus (flac and opus need the soundfile package)
+recording_segment_minutes = 30  # start a new file this often, transmissions also get a file per PTT session
+
+# Metrics configuration
+
+metrics_port = None  # e.g. 9108 to serve Prometheus metrics on http://127.0.0.1:9108/metrics
 
 # Don't touch anything below for regular use
 if __name__ == '__main__':
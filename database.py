@@ -1,4 +1,7 @@
+import queue
 import sqlite3
+import threading
+import time
 from contextlib import closing
 
 
@@ -9,64 +12,250 @@ class Operator:
         self.admin = admin
 
 
+class MigrationError(Exception):
+    pass
+
+
+def check_callsign_conflicts(cursor: sqlite3.Cursor):
+    # picking one of them would quietly take away everyone else's permission to transmit
+    rows = cursor.execute('''SELECT callsign, uuid FROM operators WHERE callsign IN
+                             (SELECT callsign FROM operators GROUP BY callsign HAVING COUNT(*) > 1)
+                             ORDER BY callsign, uuid''').fetchall()
+    if not rows:
+        return
+
+    print('These operators share a callsign, which is no longer allowed:')
+    for callsign, uuid in rows:
+        print(f'  {callsign}: {uuid}')
+
+    raise MigrationError('Operators with the same callsign found, the database was left unchanged. Keep only one '
+                         'operator per callsign (e.g. with the sqlite3 command line tool) and start the bot again')
+
+
+# each entry upgrades the schema from the previous version, append new ones to the end. an entry is either SQL or a
+# function that gets the cursor, all of it runs in one transaction
+MIGRATIONS = [
+    # 1: the original table
+    ['''CREATE TABLE IF NOT EXISTS operators
+        (uuid INTEGER, callsign TEXT, admin INTEGER)'''],
+
+    # 2: uuid primary key and unique callsigns. the latest row wins where older versions stored one user twice,
+    # different users sharing a callsign have to be sorted out by hand
+    ['DELETE FROM operators WHERE rowid NOT IN (SELECT MAX(rowid) FROM operators GROUP BY uuid)',
+     check_callsign_conflicts,
+     '''CREATE TABLE operators_new
+        (uuid INTEGER PRIMARY KEY, callsign TEXT NOT NULL, admin INTEGER NOT NULL DEFAULT 0)''',
+     'INSERT INTO operators_new SELECT uuid, callsign, admin FROM operators',
+     'DROP TABLE operators',
+     'ALTER TABLE operators_new RENAME TO operators',
+     'CREATE UNIQUE INDEX operators_callsign ON operators (callsign)'],
+]
+
+
+def migrate(connection: sqlite3.Connection):
+    with closing(connection.cursor()) as cursor:
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        row = cursor.execute('SELECT version FROM schema_version').fetchone()
+        version = row[0] if row else 0
+
+        for i, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            with connection:
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+
+                cursor.execute('DELETE FROM schema_version')
+                cursor.execute('INSERT INTO schema_version VALUES (?)', (i,))
+
+
 class BotDatabase:
-    def __init__(self, filename):
-        self.connection = sqlite3.connect(filename)
+    # Reads are served from the in-memory operator index. Writes are queued to a single writer
+    # thread that groups them into short transactions, so slash commands never wait on disk.
+    def __init__(self, filename, commit_interval: float = 0.05):
+        self.filename = filename
+        self.commit_interval = commit_interval
+        self.total_changes = 0
+
+        with closing(sqlite3.connect(filename)) as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            migrate(connection)
+
+            with closing(connection.cursor()) as cursor:
+                rows = cursor.execute('SELECT uuid, callsign, admin FROM operators').fetchall()
+
+        # every permission check is served from here, keyed by discord user id. the sink holds a
+        # reference to this same dict so it sees operator changes immediately
+        self.operators: dict[int, Operator] = {row[0]: Operator(row[0], row[1], row[2]) for row in rows}
+
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.run_writer, name='database-writer', daemon=True)
+        self.writer.start()
+
+    def run_writer(self):
+        connection = sqlite3.connect(self.filename)
+        # with WAL this still survives the bot crashing, only a power cut can lose the last commit
+        connection.execute('PRAGMA synchronous=NORMAL')
+        running = True
 
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute(
-                '''CREATE TABLE IF NOT EXISTS operators 
-                (uuid INTEGER, callsign TEXT, admin INTEGER)'''
-            )
+        while running:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.commit_interval
+
+            while batch[-1] is not None and (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self.writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self.write_batch(connection, [item for item in batch if isinstance(item, tuple)])
+                self.total_changes = connection.total_changes
+            except Exception as e:
+                print(f'Error writing to the database: {e}')
+            finally:
+                # whatever happened, nobody waiting in commit() or close() may be left hanging
+                for item in batch:
+                    if item is None:
+                        running = False
+                    elif isinstance(item, threading.Event):
+                        item.set()
+
+        connection.close()
+
+    @staticmethod
+    def write_batch(connection: sqlite3.Connection, statements):
+        try:
+            with connection:
+                for statement, params, rollback in statements:
+                    connection.execute(statement, params)
+
+            return
+
+        except Exception:
+            pass
+
+        # don't let one bad statement take the rest of the batch with it
+        for statement, params, rollback in statements:
+            try:
+                with connection:
+                    connection.execute(statement, params)
+            except Exception as e:
+                print(f'Error writing to the database, undoing the change: {e}')
+
+                if rollback:
+                    rollback()
+
+    def execute(self, statement: str, params: tuple, rollback=None):
+        # the operator index is updated straight away, rollback puts it back if the write fails
+        self.writes.put((statement, params, rollback))
 
     def close(self):
-        self.commit()
-        self.connection.close()
+        self.writes.put(None)
+        self.writer.join()
 
     def commit(self):
-        self.connection.commit()
+        # waits until everything queued so far is on disk
+        done = threading.Event()
+        self.writes.put(done)
+        done.wait()
 
     def get_total_changes(self):
-        return self.connection.total_changes
+        return self.total_changes
 
     def get_operator(self, operator_id: int):
-        try:
-            with closing(self.connection.cursor()) as cursor:
-                row = cursor.execute('SELECT * FROM operators WHERE uuid = ?', (operator_id,)).fetchall()[0]
-        except IndexError:
-            return None
+        return self.operators.get(operator_id)
 
-        return Operator(row[0], row[1], row[2])
+    def get_callsign(self, operator_id: int):
+        operator = self.operators.get(operator_id)
+        return operator.callsign if operator else None
 
     def get_operators(self):
-        with closing(self.connection.cursor()) as cursor:
-            rows = cursor.execute('SELECT * FROM operators').fetchall()
+        return list(self.operators.values())
 
-        operators = []
+    def is_operator(self, operator_id: int):
+        return operator_id in self.operators
 
-        for row in rows:
-            uuid = row[0]
-            callsign = row[1]
-            admin = row[2]
-            operators.append(Operator(uuid, callsign, admin))
+    def is_admin(self, operator_id: int):
+        operator = self.operators.get(operator_id)
+        return operator is not None and bool(operator.admin)
 
-        return operators
+    def get_operator_by_callsign(self, callsign: str):
+        for operator in self.operators.values():
+            if operator.callsign == callsign:
+                return operator
+
+        return None
+
+    def check_callsign_free(self, callsign: str, uuid: int):
+        owner = self.get_operator_by_callsign(callsign)
+        if owner is not None and owner.uuid != uuid:
+            raise ValueError(f'Callsign {callsign} already belongs to another operator')
 
     def add_operator(self, uuid: int, callsign: str, admin: bool = False):
         admin_int = 1 if admin else 0
+        self.check_callsign_free(callsign, uuid)
+
+        previous = self.operators.get(uuid)
+        operator = Operator(uuid, callsign, admin_int)
+
+        # each rollback only undoes its own change, never one made after it
+        def rollback():
+            if self.operators.get(uuid) is operator:
+                if previous is None:
+                    del self.operators[uuid]
+                else:
+                    self.operators[uuid] = previous
+
+        self.operators[uuid] = operator
 
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute('INSERT INTO operators VALUES (?, ?, ?)',
-                           (uuid, callsign, admin_int))
+        self.execute('''INSERT INTO operators VALUES (?, ?, ?)
+                        ON CONFLICT (uuid) DO UPDATE SET callsign = excluded.callsign, admin = excluded.admin''',
+                     (uuid, callsign, admin_int), rollback)
 
     def delete_operator(self, operator_id: int):
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute('DELETE FROM operators WHERE uuid = ?', (operator_id,))
+        previous = self.operators.pop(operator_id, None)
+
+        def rollback():
+            if previous is not None:
+                self.operators.setdefault(operator_id, previous)
+
+        self.execute('DELETE FROM operators WHERE uuid = ?', (operator_id,), rollback)
 
     def update_operator_callsign(self, uuid: int, new_call: str):
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute('UPDATE operators SET callsign = ? WHERE uuid = ?', (new_call, uuid))
+        self.check_callsign_free(new_call, uuid)
+
+        operator = self.operators.get(uuid)
+        old_call = operator.callsign if operator else None
+
+        def rollback():
+            if operator is not None and operator.callsign == new_call:
+                operator.callsign = old_call
+
+        if operator is not None:
+            operator.callsign = new_call
+
+        self.execute('UPDATE operators SET callsign = ? WHERE uuid = ?', (new_call, uuid), rollback)
 
     def update_operator_uuid(self, callsign: str, new_uuid: int):
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute('UPDATE operators SET uuid = ? WHERE callsign = ?', (new_uuid, callsign))
+        operator = self.get_operator_by_callsign(callsign)
+        if operator is None or operator.uuid == new_uuid:
+            return
+
+        if new_uuid in self.operators:
+            raise ValueError(f'User {new_uuid} is already an operator')
+
+        old_uuid = operator.uuid
+
+        def rollback():
+            if self.operators.get(new_uuid) is operator and old_uuid not in self.operators:
+                del self.operators[new_uuid]
+                operator.uuid = old_uuid
+                self.operators[old_uuid] = operator
+
+        del self.operators[old_uuid]
+        operator.uuid = new_uuid
+        self.operators[new_uuid] = operator
+
+        self.execute('UPDATE operators SET uuid = ? WHERE callsign = ?', (new_uuid, callsign), rollback)
@@ -1,66 +1,191 @@
 from ctypes import *
+from concurrent.futures import ThreadPoolExecutor
 import platform
+import threading
+import time
+import numpy as np
+from numpy.ctypeslib import ndpointer
+from ring_buffer import PCMRingBuffer
+from telemetry import ModemTelemetry
+import metrics
 
+# from freedv_api.h
+FREEDV_MODES = {
+    '1600': 0,
+    '700C': 6,
+    '700D': 7,
+    '2020': 8,
+    '700E': 13,
+    '2020B': 16,
+}
 
-class FreeDV700D:
-    def __init__(self):
-        libname = None
-        system = platform.system()
+# rx status flags, from freedv_api.h
+FREEDV_RX_SYNC = 0x2
+FREEDV_RX_BIT_ERRORS = 0x8
+
+# array sizes from modem_stats.h
+MODEM_STATS_NC_MAX = 50
+MODEM_STATS_NR_MAX = 320
+MODEM_STATS_ET_MAX = 8
+MODEM_STATS_EYE_IND_MAX = 160
+MODEM_STATS_NSPEC = 512
+MODEM_STATS_MAX_F_EST = 4
+
+
+class COMP(Structure):
+    _fields_ = [('real', c_float), ('imag', c_float)]
+
+
+class MODEM_STATS(Structure):
+    # struct MODEM_STATS from modem_stats.h, for a desktop (not __EMBEDDED__) libcodec2 build
+    _fields_ = [
+        ('Nc', c_int),
+        ('snr_est', c_float),
+        ('rx_symbols', COMP * (MODEM_STATS_NC_MAX + 1) * MODEM_STATS_NR_MAX),
+        ('nr', c_int),
+        ('sync', c_int),
+        ('foff', c_float),
+        ('rx_timing', c_float),
+        ('clock_offset', c_float),
+        ('sync_metric', c_float),
+        ('pre', c_int),
+        ('post', c_int),
+        ('uw_fails', c_int),
+        ('rx_eye', c_float * MODEM_STATS_EYE_IND_MAX * MODEM_STATS_ET_MAX),
+        ('neyetr', c_int),
+        ('neyesamp', c_int),
+        ('f_est', c_float * MODEM_STATS_MAX_F_EST),
+        ('fft_buf', c_float * (2 * MODEM_STATS_NSPEC)),
+        ('fft_cfg', c_void_p),
+        # headroom in case this libcodec2 has grown the struct, it must never write past our copy
+        ('reserved', c_char * 4096),
+    ]
+
+
+# lets rx / tx hand numpy buffers straight to libcodec2 without any copies
+int16_array = ndpointer(dtype=np.int16, flags='C_CONTIGUOUS')
 
-        if system == 'Linux':
-            libname = './lib/libcodec2.so'
-        elif system == 'Windows':
-            libname = './lib/libcodec2.dll'
+c_lib = None
 
-        assert libname is not None
 
-        self.c_lib = CDLL(libname)
+def load_codec2():
+    global c_lib
 
-        self.c_lib.freedv_open.argtype = [c_int]
-        self.c_lib.freedv_open.restype = c_void_p
+    if c_lib is not None:
+        return c_lib
 
-        self.c_lib.freedv_close.argtype = [c_void_p]
-        self.c_lib.freedv_close.restype = c_void_p
+    libname = None
+    system = platform.system()
 
-        self.c_lib.freedv_get_n_max_speech_samples.argtype = [c_void_p]
-        self.c_lib.freedv_get_n_max_speech_samples.restype = c_int
+    if system == 'Linux':
+        libname = './lib/libcodec2.so'
+    elif system == 'Windows':
+        libname = './lib/libcodec2.dll'
 
-        self.c_lib.freedv_get_n_speech_samples.argtype = [c_void_p]
-        self.c_lib.freedv_get_n_speech_samples.restype = c_int
+    assert libname is not None
 
-        self.c_lib.freedv_get_n_nom_modem_samples.argtype = [c_void_p]
-        self.c_lib.freedv_get_n_nom_modem_samples.restype = c_int
+    lib = CDLL(libname)
 
-        self.c_lib.freedv_get_sync.argtype = [c_void_p]
-        self.c_lib.freedv_get_sync.restype = c_int
+    lib.freedv_open.argtypes = [c_int]
+    lib.freedv_open.restype = c_void_p
 
-        self.c_lib.freedv_get_rx_status.argtype = [c_void_p]
-        self.c_lib.freedv_get_rx_status.restype = c_int
+    lib.freedv_close.argtypes = [c_void_p]
+    lib.freedv_close.restype = None
 
-        self.c_lib.freedv_nin.argtype = [c_void_p]
-        self.c_lib.freedv_nin.restype = c_int
+    for name in ['freedv_get_n_max_speech_samples', 'freedv_get_n_speech_samples',
+                 'freedv_get_n_nom_modem_samples', 'freedv_get_n_max_modem_samples',
+                 'freedv_get_speech_sample_rate', 'freedv_get_modem_sample_rate',
+                 'freedv_get_sync', 'freedv_get_rx_status', 'freedv_nin']:
+        getattr(lib, name).argtypes = [c_void_p]
+        getattr(lib, name).restype = c_int
 
-        self.c_lib.freedv_rx.argtype = [c_void_p, c_char_p, c_char_p]
-        self.c_lib.freedv_rx.restype = c_int
+    lib.freedv_rx.argtypes = [c_void_p, int16_array, int16_array]
+    lib.freedv_rx.restype = c_int
 
-        self.c_lib.freedv_tx.argtype = [c_void_p, c_char_p, c_char_p]
-        self.c_lib.freedv_tx.restype = c_void_p
+    lib.freedv_tx.argtypes = [c_void_p, int16_array, int16_array]
+    lib.freedv_tx.restype = None
 
-        FREEDV_MODE_700D = 7  # from freedv_api.h
-        self.freedv = cast(self.c_lib.freedv_open(FREEDV_MODE_700D), c_void_p)
+    lib.freedv_get_modem_stats.argtypes = [c_void_p, POINTER(c_int), POINTER(c_float)]
+    lib.freedv_get_modem_stats.restype = None
 
-        self.n_speech_samples = self.c_lib.freedv_get_n_speech_samples(self.freedv)
+    lib.freedv_get_modem_extended_stats.argtypes = [c_void_p, POINTER(MODEM_STATS)]
+    lib.freedv_get_modem_extended_stats.restype = None
 
-        self.n_max_speech_samples = self.c_lib.freedv_get_n_max_speech_samples(self.freedv)
-        self.speech_out = create_string_buffer(2 * self.n_max_speech_samples)
+    c_lib = lib
+    return c_lib
 
-        self.n_nom_modem_samples = self.c_lib.freedv_get_n_nom_modem_samples(self.freedv)
-        self.mod_out = create_string_buffer(2 * self.n_nom_modem_samples)
 
+class FreeDV:
+    def __init__(self, mode: str = '700D', labels: dict | None = None):
+        self.c_lib = load_codec2()
+        self.labels = labels or {}
+        # reentrant, so demodulate() can hold it across a whole frame while rx() and the stats take it too
+        self.lock = threading.RLock()
+
+        self.freedv = None
+        self.mode = None
         self.analog_listen = False
 
+        self.rx_input = PCMRingBuffer(8000 * 4)
+        self.rx_block = np.empty(0, dtype=np.int16)
+        self.synced = False
+        self.snr_est = 0.0
+        self.stats_sync = c_int()
+        self.stats_snr = c_float()
+        self.rx_frames = 0
+        self.synced_frames = 0
+        self.frame_errors = 0
+        self.rx_cpu_time = 0.0
+
+        # written by libcodec2, far too big to allocate on every call
+        self.extended_stats = MODEM_STATS()
+        self.telemetry = ModemTelemetry()
+
+        self.set_mode(mode)
+
+    def set_mode(self, mode: str):
+        if mode not in FREEDV_MODES:
+            raise ValueError(f'Unknown FreeDV mode {mode}, choose from {", ".join(FREEDV_MODES)}')
+
+        handle = self.c_lib.freedv_open(FREEDV_MODES[mode])
+        if not handle:
+            raise ValueError(f'FreeDV mode {mode} is not available in this libcodec2 build')
+
+        # the pipeline thread may be in the middle of rx / tx, swap everything over in one go
+        with self.lock:
+            if self.freedv:
+                self.c_lib.freedv_close(self.freedv)
+
+            self.freedv = handle
+            self.mode = mode
+
+            self.rx_time = metrics.registry.histogram('discdv_modem_seconds', 'Time spent in libcodec2 rx / tx calls',
+                                                      {**self.labels, 'op': 'rx', 'mode': mode})
+            self.tx_time = metrics.registry.histogram('discdv_modem_seconds', 'Time spent in libcodec2 rx / tx calls',
+                                                      {**self.labels, 'op': 'tx', 'mode': mode})
+
+            self.speech_sample_rate = self.c_lib.freedv_get_speech_sample_rate(self.freedv)
+            self.modem_sample_rate = self.c_lib.freedv_get_modem_sample_rate(self.freedv)
+            self.n_speech_samples = self.c_lib.freedv_get_n_speech_samples(self.freedv)
+
+            self.n_max_speech_samples = self.c_lib.freedv_get_n_max_speech_samples(self.freedv)
+            self.speech_out = np.zeros(self.n_max_speech_samples, dtype=np.int16)
+            self.silence = np.zeros(self.n_max_speech_samples, dtype=np.int16)
+
+            self.n_nom_modem_samples = self.c_lib.freedv_get_n_nom_modem_samples(self.freedv)
+            self.mod_out = np.zeros(self.n_nom_modem_samples, dtype=np.int16)
+
+            self.n_max_modem_samples = self.c_lib.freedv_get_n_max_modem_samples(self.freedv)
+            self.rx_block = np.zeros(self.n_max_modem_samples, dtype=np.int16)
+
+        # stats from the old mode don't say anything about this one
+        self.telemetry.clear()
+
     def close(self):
-        self.c_lib.freedv_close(self.freedv)
+        with self.lock:
+            if self.freedv:
+                self.c_lib.freedv_close(self.freedv)
+                self.freedv = None
 
     def get_sync(self):
         return self.c_lib.freedv_get_sync(self.freedv)
@@ -71,31 +196,159 @@ class FreeDV700D:
     def get_nin(self):
         return self.c_lib.freedv_nin(self.freedv)
 
+    def get_modem_stats(self):
+        self.c_lib.freedv_get_modem_stats(self.freedv, byref(self.stats_sync), byref(self.stats_snr))
+        return self.stats_sync.value, self.stats_snr.value
+
+    def get_extended_stats(self):
+        with self.lock:
+            self.c_lib.freedv_get_modem_extended_stats(self.freedv, byref(self.extended_stats))
+
+        stats = self.extended_stats
+        return stats.sync, stats.snr_est, stats.foff, stats.clock_offset, stats.sync_metric
+
+    def sample_telemetry(self):
+        self.telemetry.record(*self.get_extended_stats(), self.rx_frames, self.frame_errors)
+
     def get_n_speech_samples(self):
         return self.n_speech_samples
 
     def listen_to_analog(self, val: bool):
         self.analog_listen = val
 
-    def rx(self, demod_in):
-        nin = self.get_nin()
-        assert len(demod_in) == nin * 2
+    # rx and tx return views of buffers owned by this object, use or copy them before the next call
+
+    def rx(self, demod_in: np.ndarray):
+        with self.lock:
+            nin = self.get_nin()
+            assert len(demod_in) == nin
+
+            start = time.perf_counter()
+            nout = self.c_lib.freedv_rx(self.freedv, self.speech_out, demod_in)
+            self.rx_time.observe(time.perf_counter() - start)
+
+            rx_status = self.get_rx_status()
+            if rx_status & FREEDV_RX_SYNC and rx_status & FREEDV_RX_BIT_ERRORS:
+                self.frame_errors += 1
 
-        nout = self.c_lib.freedv_rx(self.freedv, self.speech_out, demod_in)
+            if rx_status != 0 and rx_status != 10 or self.analog_listen:
+                return self.speech_out[:nout]
+            else:
+                return self.silence[:nout]
 
-        # if self.get_rx_status() == 6 or self.analog_listen:
-        #     return self.speech_out[:nout * 2]
-        #
-        # else:
-        #     return b'\x00\x00'
-        rx_status = self.get_rx_status()
-        if rx_status != 0 and rx_status != 10 or self.analog_listen:
-            return self.speech_out[:nout * 2]
-        else:
-            return b'\x00\x00'
+    def demodulate(self, samples: np.ndarray):
+        # streaming wrapper around rx(), takes modem audio in any block size and returns all the
+        # speech decoded from it so far
+        start = time.thread_time()
+        self.rx_input.write(samples)
+        self.telemetry.capture(samples)
+        speech = []
 
-    def tx(self, speech_in):
-        assert len(speech_in) == self.get_n_speech_samples() * 2
+        while True:
+            # nin, rx and the stats all have to see the same handle, set_mode() may close it at any time
+            with self.lock:
+                if self.freedv is None:
+                    break
+
+                nin = self.get_nin()
+                if self.rx_input.available() < nin or nin > len(self.rx_block):
+                    break
+
+                speech.append(self.rx(self.rx_input.read(nin, out=self.rx_block)).copy())
+
+                sync, self.snr_est = self.get_modem_stats()
+                self.synced = bool(sync)
+                self.rx_frames += 1
+                if self.synced:
+                    self.synced_frames += 1
+
+                # the extended stats are a much bigger copy, so only a few times a second
+                if self.telemetry.due():
+                    self.sample_telemetry()
+
+        self.rx_cpu_time += time.thread_time() - start
+        return np.concatenate(speech) if speech else self.silence[:0]
+
+    def tx(self, speech_in: np.ndarray):
+        with self.lock:
+            # the caller sized the frame before a mode change, drop it rather than hand libcodec2 the wrong length
+            if self.freedv is None or len(speech_in) != self.n_speech_samples:
+                return None
+
+            start = time.perf_counter()
+            self.c_lib.freedv_tx(self.freedv, self.mod_out, speech_in)
+            self.tx_time.observe(time.perf_counter() - start)
+
+            return self.mod_out
+
+
+class FreeDV700D(FreeDV):
+    def __init__(self):
+        super().__init__('700D')
+
+
+class MultiModeReceiver:
+    # Feeds the same modem audio to one FreeDV instance per mode and plays whichever one has sync.
+    # libcodec2 calls release the GIL, so the demodulators really do run in parallel on the pool.
+    def __init__(self, modes: list[str], modem=None, labels: dict | None = None):
+        # modem builds each receiver, FreeDV unless the station runs its modems out of process
+        self.receivers = [(modem or FreeDV)(mode, labels) for mode in modes]
+        self.active = self.receivers[0]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.receivers), thread_name_prefix='freedv-rx')
+
+    @property
+    def mode(self):
+        return self.active.mode
+
+    @property
+    def speech_sample_rate(self):
+        return self.active.speech_sample_rate
+
+    @property
+    def modem_sample_rate(self):
+        return self.active.modem_sample_rate
+
+    @property
+    def synced(self):
+        return self.active.synced
+
+    @property
+    def snr_est(self):
+        return self.active.snr_est
+
+    @property
+    def telemetry(self):
+        return self.active.telemetry
+
+    @property
+    def frame_errors(self):
+        # summed, so the total never goes backwards when a different receiver becomes active
+        return sum(receiver.frame_errors for receiver in self.receivers)
+
+    def listen_to_analog(self, val: bool):
+        for receiver in self.receivers:
+            receiver.listen_to_analog(val)
+
+    def demodulate(self, samples: np.ndarray):
+        outputs = list(self.executor.map(lambda receiver: receiver.demodulate(samples), self.receivers))
+
+        # stay with the current mode for as long as it holds sync, otherwise follow any that syncs
+        if not self.active.synced:
+            for receiver in self.receivers:
+                if receiver.synced:
+                    self.active = receiver
+                    break
+
+        return outputs[self.receivers.index(self.active)]
+
+    def get_stats(self):
+        return [f'{receiver.mode}{" (active)" if receiver is self.active else ""}: '
+                f'{"synced" if receiver.synced else "no sync"}, {receiver.synced_frames}/{receiver.rx_frames} '
+                f'frames synced, {receiver.rx_cpu_time:.2f} s CPU'
+                for receiver in self.receivers]
+
+    def close(self):
+        self.executor.shutdown()
 
-        self.c_lib.freedv_tx(self.freedv, self.mod_out, speech_in)
-        return self.mod_out
+        for receiver in self.receivers:
+            receiver.close()
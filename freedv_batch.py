@@ -0,0 +1,270 @@
+# Offline FreeDV encode / decode for whole directories of recordings, no radio, soundcard or discord needed.
+#
+#   python freedv_batch.py decode offair/*.wav --mode 700D --out decoded
+#   python freedv_batch.py encode speech/*.wav --mode 700E --out modulated --json stats.json
+#
+# Every file runs through the same FreeDV.rx / FreeDV.tx calls the bot uses, one frame at a time, with
+# files spread over a process pool. Input WAVs are 16 bit, stereo files use the left channel, and any
+# rate that is a whole multiple or fraction of the modem rate (e.g. 48 kHz recordings) is resampled.
+
+import argparse
+import json
+import os
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import freedv
+from resampler import StreamingResampler
+from ring_buffer import PCMRingBuffer
+
+# how much of the input file is read at a time
+READ_SECONDS = 0.5
+
+
+def open_input(path: str, rate: int):
+    wav = wave.open(path, 'rb')
+
+    if wav.getsampwidth() != 2:
+        wav.close()
+        raise ValueError(f'{path} is not 16 bit audio')
+
+    in_rate = wav.getframerate()
+    if in_rate != rate and max(in_rate, rate) % min(in_rate, rate):
+        wav.close()
+        raise ValueError(f'{path} is {in_rate} Hz, which can\'t be resampled to {rate} Hz')
+
+    return wav
+
+
+def read_blocks(wav: wave.Wave_read, rate: int):
+    # yields the file in blocks at the wanted rate, without ever loading all of it
+    channels = wav.getnchannels()
+    resampler = StreamingResampler(wav.getframerate(), rate) if wav.getframerate() != rate else None
+    block_frames = int(wav.getframerate() * READ_SECONDS)
+
+    while True:
+        data = wav.readframes(block_frames)
+        if not data:
+            break
+
+        samples = np.frombuffer(data, dtype=np.int16)
+        if channels > 1:
+            samples = samples[::channels]
+
+        yield resampler.process(samples) if resampler else samples
+
+
+def open_output(path: str, rate: int):
+    wav = wave.open(path, 'wb')
+    wav.setnchannels(1)
+    wav.setsampwidth(2)
+    wav.setframerate(rate)
+    return wav
+
+
+def output_names(paths):
+    # inputs from different directories can share a file name, later ones get _2, _3, ... so none overwrites another
+    names = {}
+    used = set()
+
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name = stem
+        n = 1
+        while name in used:
+            n += 1
+            name = f'{stem}_{n}'
+
+        used.add(name)
+        names[path] = name
+
+    return names
+
+
+def output_path(name: str, out_dir: str, suffix: str):
+    return os.path.join(out_dir, f'{name}_{suffix}.wav')
+
+
+def decode_file(path: str, mode: str, out_dir: str, analog_listen: bool = False, name: str | None = None):
+    start = time.perf_counter()
+    name = name or output_names([path])[path]
+    fdv = freedv.FreeDV(mode)
+    fdv.listen_to_analog(analog_listen)
+
+    frames = 0
+    synced_frames = 0
+    sync_losses = 0
+    first_sync = None
+    snrs = []
+    modem_samples = 0
+    was_synced = False
+
+    try:
+        with open_input(path, fdv.modem_sample_rate) as wav_in, \
+                open_output(output_path(name, out_dir, 'decoded'), fdv.speech_sample_rate) as wav_out:
+            pending = PCMRingBuffer(fdv.modem_sample_rate * 4)
+            frame = np.zeros(fdv.n_max_modem_samples, dtype=np.int16)
+
+            for block in read_blocks(wav_in, fdv.modem_sample_rate):
+                pending.write(block)
+
+                # nin changes from frame to frame while the demodulator tracks timing
+                while pending.available() >= fdv.get_nin():
+                    nin = fdv.get_nin()
+                    speech = fdv.rx(pending.read(nin, out=frame))
+                    wav_out.writeframes(speech.tobytes())
+
+                    sync, snr = fdv.get_modem_stats()
+                    if sync:
+                        synced_frames += 1
+                        snrs.append(snr)
+
+                        if first_sync is None:
+                            first_sync = modem_samples / fdv.modem_sample_rate
+                    elif was_synced:
+                        sync_losses += 1
+
+                    was_synced = bool(sync)
+                    modem_samples += nin
+                    frames += 1
+    finally:
+        fdv.close()
+
+    elapsed = time.perf_counter() - start
+    duration = modem_samples / fdv.modem_sample_rate
+
+    return {
+        'file': path,
+        'mode': mode,
+        'seconds': round(duration, 2),
+        'frames': frames,
+        'synced_frames': synced_frames,
+        'sync_percent': round(100 * synced_frames / frames, 1) if frames else 0.0,
+        'first_sync_seconds': round(first_sync, 2) if first_sync is not None else None,
+        'sync_losses': sync_losses,
+        'snr_mean': round(float(np.mean(snrs)), 1) if snrs else None,
+        'snr_min': round(float(np.min(snrs)), 1) if snrs else None,
+        'snr_max': round(float(np.max(snrs)), 1) if snrs else None,
+        'realtime': round(duration / elapsed, 1) if elapsed else None,
+    }
+
+
+def encode_file(path: str, mode: str, out_dir: str, name: str | None = None):
+    start = time.perf_counter()
+    name = name or output_names([path])[path]
+    fdv = freedv.FreeDV(mode)
+
+    frames = 0
+    n = fdv.get_n_speech_samples()
+
+    try:
+        with open_input(path, fdv.speech_sample_rate) as wav_in, \
+                open_output(output_path(name, out_dir, fdv.mode), fdv.modem_sample_rate) as wav_out:
+            pending = PCMRingBuffer(fdv.speech_sample_rate * 4)
+            frame = np.zeros(n, dtype=np.int16)
+
+            for block in read_blocks(wav_in, fdv.speech_sample_rate):
+                pending.write(block)
+
+                while pending.available() >= n:
+                    wav_out.writeframes(fdv.tx(pending.read(n, out=frame)).tobytes())
+                    frames += 1
+
+            # pad the last partial frame out with silence
+            remaining = pending.available()
+            if remaining:
+                frame.fill(0)
+                pending.read(remaining, out=frame[:remaining])
+                wav_out.writeframes(fdv.tx(frame).tobytes())
+                frames += 1
+    finally:
+        fdv.close()
+
+    elapsed = time.perf_counter() - start
+    duration = frames * n / fdv.speech_sample_rate
+
+    return {
+        'file': path,
+        'mode': mode,
+        'seconds': round(duration, 2),
+        'frames': frames,
+        'realtime': round(duration / elapsed, 1) if elapsed else None,
+    }
+
+
+def run_file(command: str, path: str, mode: str, out_dir: str, analog_listen: bool, name: str):
+    try:
+        if command == 'decode':
+            return decode_file(path, mode, out_dir, analog_listen, name)
+        else:
+            return encode_file(path, mode, out_dir, name)
+    except Exception as e:
+        return {'file': path, 'mode': mode, 'error': str(e)}
+
+
+def format_result(result: dict):
+    if 'error' in result:
+        return f'{result["file"]}: ERROR {result["error"]}'
+
+    line = f'{result["file"]}: {result["seconds"]:.1f} s, {result["frames"]} frames'
+
+    if 'sync_percent' in result:
+        line += f', {result["sync_percent"]:.1f} % synced'
+
+        if result['first_sync_seconds'] is not None:
+            line += (f' (first at {result["first_sync_seconds"]:.1f} s, {result["sync_losses"]} losses), '
+                     f'SNR {result["snr_mean"]:.1f} dB [{result["snr_min"]:.1f} .. {result["snr_max"]:.1f}]')
+
+    return line + f', {result["realtime"]:.0f}x realtime'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode or decode WAV files with FreeDV offline')
+    parser.add_argument('command', choices=['decode', 'encode'],
+                        help='decode off-air recordings to speech, or encode speech to modem audio')
+    parser.add_argument('files', nargs='+', help='WAV files to process')
+    parser.add_argument('--mode', default='700D', choices=list(freedv.FREEDV_MODES))
+    parser.add_argument('--out', default='batch_output', help='directory for the output WAV files')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='files processed in parallel')
+    parser.add_argument('--analog-listen', action='store_true', help='pass audio through when not synced')
+    parser.add_argument('--json', help='also write the per-file stats to this file')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+
+    # the same file given twice is only processed once
+    files = list(dict.fromkeys(args.files))
+    names = output_names(files)
+
+    # one modem per file, each worker process loads libcodec2 once
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_file, args.command, path, args.mode, args.out, args.analog_listen,
+                                   names[path])
+                   for path in files]
+
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(format_result(result))
+
+    elapsed = time.perf_counter() - start
+    total = sum(result.get('seconds', 0) for result in results)
+    errors = sum('error' in result for result in results)
+
+    print(f'{len(results)} files, {total:.1f} s of audio in {elapsed:.1f} s '
+          f'({total / elapsed:.0f}x realtime), {errors} errors')
+
+    if args.json:
+        results.sort(key=lambda result: result['file'])
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,189 @@
+import time
+import numpy as np
+from ring_buffer import PCMRingBuffer
+
+
+class DriftCorrector:
+    # Linear interpolation resampler for ratios a fraction of a percent either side of 1. The fractional
+    # read position and the last frame of the previous block carry over, so consecutive blocks join up.
+    def __init__(self, channels: int = 1):
+        self.channels = channels
+        self.phase = 0.0
+        self.last_frame = np.zeros(channels, dtype=np.float32)
+
+    def process(self, samples: np.ndarray, ratio: float):
+        frames = samples.reshape(-1, self.channels)
+        if not len(frames):
+            return samples
+
+        stream = np.empty((len(frames) + 1, self.channels), dtype=np.float32)
+        stream[0] = self.last_frame
+        stream[1:] = frames
+
+        step = 1.0 / ratio
+        count = int(np.ceil((len(frames) - self.phase) / step))
+        positions = self.phase + np.arange(count) * step
+
+        index = positions.astype(np.int64)
+        fraction = (positions - index).astype(np.float32)[:, None]
+        output = stream[index] * (1 - fraction) + stream[index + 1] * fraction
+
+        self.phase = self.phase + count * step - len(frames)
+        self.last_frame = stream[-1].copy()
+
+        np.rint(output, out=output)
+        return output.astype(np.int16).reshape(-1)
+
+
+class JitterBuffer:
+    # A ring buffer that holds a steady amount of audio between two independent clocks (the soundcard
+    # and discord). Reads smooth out the measured depth, and writes are stretched or squeezed by a tiny
+    # fractional resampling ratio so the depth settles on the target instead of drifting over hours.
+    def __init__(self, rate: int, channels: int = 1, target_ms: float = 100, max_ms: float | None = None,
+                 max_correction: float = 0.005, gain: float = 0.05, smoothing: float = 0.01):
+        self.rate = rate
+        self.channels = channels
+
+        self.target = self.base_target = int(rate * target_ms / 1000) * channels
+        self.max_depth = self.base_max_depth = int(rate * (max_ms or target_ms * 3) / 1000) * channels
+        self.buffer = PCMRingBuffer(self.max_depth * 2)
+
+        self.max_correction = max_correction
+        self.gain = gain
+        self.smoothing = smoothing
+
+        self.ratio = 1.0
+        self.smoothed_depth = float(self.target)
+        self.playing = False
+        self.bursts = 0
+        self.last_write = 0.0
+
+        self.corrector = DriftCorrector(channels)
+
+    def available(self):
+        return self.buffer.available()
+
+    def fill_level(self):
+        return self.buffer.fill_level()
+
+    @property
+    def overflows(self):
+        # writes that didn't fit at all, plus ones that left more than max_depth for read() to drop
+        return self.buffer.overflows + self.bursts
+
+    @property
+    def underruns(self):
+        return self.buffer.underruns
+
+    def latency(self):
+        return self.buffer.available() / self.channels / self.rate
+
+    def idle(self):
+        # seconds since the writer last wrote anything
+        return time.monotonic() - self.last_write
+
+    def clear(self):
+        self.buffer.clear()
+        self.playing = False
+
+    def set_read_size(self, n: int):
+        # a reader that takes n samples at a time needs them on top of the target, or the depth never settles on it
+        self.target = self.base_target + n
+        self.max_depth = self.base_max_depth + n
+
+    def update_ratio(self):
+        # ahead of the target means the writer's clock is fast, so produce slightly fewer samples
+        error = (self.smoothed_depth - self.target) / self.target
+        self.ratio = 1.0 - min(max(error * self.gain, -self.max_correction), self.max_correction)
+        return self.ratio
+
+    def write(self, samples: np.ndarray, stretch: bool = True):
+        # writers that can apply the ratio somewhere cheaper (e.g. before upsampling) pass stretch=False
+        if stretch:
+            samples = self.corrector.process(samples, self.update_ratio())
+
+        written = self.buffer.write(samples)
+        self.last_write = time.monotonic()
+
+        # only the reader may move read_pos, so trimming a burst is left to read()
+        if written == len(samples) and self.buffer.available() > self.max_depth:
+            self.bursts += 1
+
+        return written
+
+    def read(self, n: int, out: np.ndarray | None = None):
+        # hard limit for big bursts the slow correction can't keep up with, drop the oldest audio
+        excess = self.buffer.available() - self.max_depth
+        if excess > 0:
+            self.buffer.discard(excess - excess % self.channels)
+
+        depth = self.buffer.available()
+        self.smoothed_depth += self.smoothing * (depth - self.smoothed_depth)
+
+        # build back up to the target before playing again, instead of stuttering on every block
+        if not self.playing:
+            if depth < self.target:
+                return None
+
+            self.playing = True
+
+        samples = self.buffer.read(n, out=out)
+        if samples is None:
+            self.playing = False
+
+        return samples
+
+    def drain(self, n: int, out: np.ndarray):
+        # whatever is left once the writer has stopped, padded with silence to n samples
+        available = self.buffer.available()
+        available = min(n, available - available % self.channels)
+        self.playing = False
+
+        if not available:
+            return None
+
+        self.buffer.read(available, out=out)
+        out[available:n] = 0
+        return out[:n]
+
+
+class TXBuffer(PCMRingBuffer):
+    # Modem audio on its way to the soundcard. Both ends run on the soundcard's clock, and a FreeDV modem
+    # can't lose or gain a single sample, so unlike the jitter buffer nothing here is ever stretched or
+    # dropped. It only waits for target samples before it starts playing, and pads the last block
+    # with silence once it runs dry.
+    def __init__(self, rate: int, target_ms: float, seconds: float = 4):
+        super().__init__(int(rate * seconds))
+        self.rate = rate
+        self.target = int(rate * target_ms / 1000)
+        self.playing = False
+
+    def latency(self):
+        return self.available() / self.rate
+
+    def clear(self):
+        super().clear()
+        self.playing = False
+
+    def read(self, n: int, out: np.ndarray | None = None):
+        available = self.available()
+        if not self.playing:
+            if available < self.target:
+                return None
+
+            self.playing = True
+
+        if available >= n:
+            return super().read(n, out=out)
+
+        # the writer stopped (or fell behind), play out the rest and build back up to the target
+        self.underruns += 1
+        self.playing = False
+
+        if out is None:
+            out = np.empty(n, dtype=np.int16)
+
+        if available:
+            super().read(available, out=out)
+        out[available:n] = 0
+        return out[:n]
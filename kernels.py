@@ -0,0 +1,118 @@
+# Per-sample DSP loops. With numba installed they are compiled once, cached on disk next to this file and run
+# without the GIL, so the DSP thread doesn't hold up the discord event loop. Without numba the same functions
+# fall back to plain numpy.
+#
+# Every kernel writes into a caller supplied output array, stereo audio is interleaved L/R int16.
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+if HAVE_NUMBA:
+    @njit(cache=True, nogil=True)
+    def stereo_to_mono(src, out):
+        for i in range(len(src) // 2):
+            value = np.int32(src[2 * i]) + np.int32(src[2 * i + 1])
+            out[i] = min(max(value, -32768), 32767)
+
+    @njit(cache=True, nogil=True)
+    def mono_to_stereo(src, out):
+        for i in range(len(src)):
+            out[2 * i] = src[i]
+            out[2 * i + 1] = src[i]
+
+    @njit(cache=True, nogil=True)
+    def mix_stereo(acc, src):
+        # adds both channels of src into the first len(src) / 2 entries of an int32 accumulator
+        for i in range(len(src) // 2):
+            acc[i] += np.int32(src[2 * i]) + np.int32(src[2 * i + 1])
+
+    @njit(cache=True, nogil=True)
+    def saturate(acc, out):
+        for i in range(len(acc)):
+            out[i] = min(max(acc[i], -32768), 32767)
+
+    @njit(cache=True, nogil=True)
+    def apply_gain_q15(src, gain, out):
+        for i in range(len(src)):
+            value = (np.int32(src[i]) * gain) >> 15
+            out[i] = min(max(value, -32768), 32767)
+
+    @njit(cache=True, nogil=True)
+    def peak(src):
+        result = 0
+        for i in range(len(src)):
+            value = abs(np.int32(src[i]))
+            if value > result:
+                result = value
+        return result
+
+    @njit(cache=True, nogil=True)
+    def rms(src):
+        total = 0.0
+        for i in range(len(src)):
+            total += np.float64(src[i]) * src[i]
+        return np.sqrt(total / len(src)) if len(src) else 0.0
+
+else:
+    def stereo_to_mono(src, out):
+        frames = src[:len(src) // 2 * 2].reshape(-1, 2)
+        mixed = frames.sum(axis=1, dtype=np.int32)
+        np.clip(mixed, -32768, 32767, out=mixed)
+        np.copyto(out[:len(mixed)], mixed, casting='unsafe')
+
+    def mono_to_stereo(src, out):
+        frames = out[:len(src) * 2].reshape(-1, 2)
+        frames[:, 0] = src
+        frames[:, 1] = src
+
+    def mix_stereo(acc, src):
+        frames = src[:len(src) // 2 * 2].reshape(-1, 2)
+        mix = acc[:len(frames)]
+        mix += frames[:, 0]
+        mix += frames[:, 1]
+
+    def saturate(acc, out):
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(out[:len(acc)], acc, casting='unsafe')
+
+    def apply_gain_q15(src, gain, out):
+        scaled = src.astype(np.int32)
+        scaled *= gain
+        scaled >>= 15
+        np.clip(scaled, -32768, 32767, out=scaled)
+        np.copyto(out[:len(src)], scaled, casting='unsafe')
+
+    def peak(src):
+        if not len(src):
+            return 0
+        return max(int(src.max()), -int(src.min()))
+
+    def rms(src):
+        if not len(src):
+            return 0.0
+        return float(np.sqrt(np.dot(src.astype(np.float64), src.astype(np.float64)) / len(src)))
+
+
+def warm_up():
+    # compiles (or loads from the on-disk cache) every kernel before the audio starts, instead of on
+    # the first block the DSP thread processes
+    stereo = np.zeros(4, dtype=np.int16)
+    mono = np.zeros(2, dtype=np.int16)
+    acc = np.zeros(2, dtype=np.int32)
+
+    stereo_to_mono(stereo, mono)
+    stereo_to_mono(np.frombuffer(stereo.tobytes(), dtype=np.int16), mono)
+    mono_to_stereo(mono, stereo)
+    mix_stereo(acc, stereo)
+    mix_stereo(acc, np.frombuffer(stereo.tobytes(), dtype=np.int16))
+    saturate(acc, mono)
+    apply_gain_q15(mono, 32768, mono)
+    peak(mono)
+    peak(np.frombuffer(stereo.tobytes(), dtype=np.int16))
+    rms(mono)
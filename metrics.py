@@ -0,0 +1,201 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds, from a fraction of a millisecond up to a whole soundcard block
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def samples(self, name: str):
+        return [(name, self.labels, self.value)]
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self, name: str):
+        return [(name, self.labels, self.value)]
+
+
+class Sampled:
+    # reads a value that is already being kept somewhere else (a ring buffer counter, a fill level)
+    # only when the metrics are scraped, so it costs nothing on the audio path
+    def __init__(self, labels: dict, fn, kind: str):
+        self.labels = labels
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self, name: str):
+        try:
+            value = self.fn()
+        except Exception:
+            value = float('nan')
+
+        return [(name, self.labels, value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, labels: dict, buckets=DURATION_BUCKETS):
+        self.labels = labels
+        self.buckets = buckets
+        # the last slot catches everything above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float):
+        # upper bound of the bucket the quantile falls in, good enough for a summary
+        target = q * self.count
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+
+        return self.max
+
+    def samples(self, name: str):
+        samples = []
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append((f'{name}_bucket', {**self.labels, 'le': bound}, total))
+
+        samples.append((f'{name}_bucket', {**self.labels, 'le': '+Inf'}, self.count))
+        samples.append((f'{name}_sum', self.labels, self.sum))
+        samples.append((f'{name}_count', self.labels, self.count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str, help_text: str, labels: dict | None, factory):
+        key = (name, tuple(sorted((labels or {}).items())))
+
+        # metrics are created up front or on first use, after that the hot path only touches the object
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = factory(labels or {})
+                self.help[name] = help_text
+
+            return self.metrics[key]
+
+    def counter(self, name: str, help_text: str, labels: dict | None = None) -> Counter:
+        return self.get(name, help_text, labels, Counter)
+
+    def gauge(self, name: str, help_text: str, labels: dict | None = None) -> Gauge:
+        return self.get(name, help_text, labels, Gauge)
+
+    def histogram(self, name: str, help_text: str, labels: dict | None = None,
+                  buckets=DURATION_BUCKETS) -> Histogram:
+        return self.get(name, help_text, labels, lambda l: Histogram(l, buckets))
+
+    def sampled(self, name: str, help_text: str, fn, labels: dict | None = None, kind: str = 'gauge'):
+        metric = self.get(name, help_text, labels, lambda l: Sampled(l, fn, kind))
+        metric.fn = fn
+        return metric
+
+    def items(self):
+        with self.lock:
+            return sorted(self.metrics.items(), key=lambda item: item[0])
+
+    def render_prometheus(self):
+        lines = []
+        last_name = None
+
+        for (name, labels), metric in self.items():
+            if name != last_name:
+                lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+                last_name = name
+
+            for sample_name, sample_labels, value in metric.samples(name):
+                lines.append(f'{sample_name}{format_labels(sample_labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        lines = []
+
+        for (name, labels), metric in self.items():
+            label_text = format_labels(metric.labels)
+
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    lines.append(f'{name}{label_text}: n={metric.count} mean={metric.sum / metric.count * 1000:.2f}ms '
+                                 f'p95<={metric.quantile(0.95) * 1000:.2f}ms max={metric.max * 1000:.2f}ms')
+            else:
+                value = metric.samples(name)[0][2]
+                lines.append(f'{name}{label_text}: {value:.3g}' if isinstance(value, float) else
+                             f'{name}{label_text}: {value}')
+
+        return lines
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, metrics_registry: Registry = registry):
+    # localhost only, this is meant for a prometheus scraper running on the same machine
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    server.registry = metrics_registry
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -0,0 +1,380 @@
+# Runs a FreeDV modem in its own process. The bot starts this file with RemoteFreeDV, it isn't meant to be
+# run by hand. Audio goes both ways through shared memory rings, commands and replies are JSON lines on
+# stdin / stdout, and a single byte on stdin wakes the modem up when there is new audio.
+
+import json
+import queue
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from multiprocessing import shared_memory
+import freedv
+import metrics
+from ring_buffer import SharedPCMRingBuffer, attach_shared_memory
+from telemetry import ModemTelemetry
+
+# ring name: capacity in samples, a few seconds at the highest rate that goes through each one
+RINGS = {
+    'rx_in': 8000 * 4,  # modem audio from the radio
+    'rx_out': 16000 * 4,  # decoded speech
+    'tx_in': 16000 * 4,  # speech to transmit
+    'tx_out': 8000 * 4,  # modulated audio for the radio
+}
+
+START_TIMEOUT = 10.0
+COMMAND_TIMEOUT = 5.0
+# seconds to wait before each restart after a crash, the last one repeats
+RESTART_DELAYS = (0.5, 1.0, 2.0, 5.0, 10.0)
+# a modem that ran this long before crashing restarts with the shortest delay again
+STABLE_TIME = 30.0
+
+# fields of the shared status block
+(STATUS_WAKE, STATUS_SYNC, STATUS_SNR, STATUS_RX_FRAMES, STATUS_SYNCED_FRAMES, STATUS_FRAME_ERRORS, STATUS_FOFF,
+ STATUS_CLOCK_OFFSET, STATUS_SYNC_METRIC, STATUS_RX_CPU_TIME) = range(10)
+STATUS_FIELDS = 10
+
+# lines on stdout starting with this are replies, anything else (e.g. libcodec2 debug output) is ignored
+REPLY_PREFIX = '@modem '
+
+
+def modem_rates(fdv: freedv.FreeDV):
+    return {'speech_sample_rate': fdv.speech_sample_rate, 'modem_sample_rate': fdv.modem_sample_rate,
+            'n_speech_samples': fdv.get_n_speech_samples()}
+
+
+def reply(kind: str, value=None):
+    sys.stdout.write(REPLY_PREFIX + json.dumps([kind, value]) + '\n')
+    sys.stdout.flush()
+
+
+def run_modem(mode: str, analog_listen: bool, rings: dict, status_name: str):
+    rx_in, rx_out, tx_in, tx_out = [SharedPCMRingBuffer(RINGS[name], rings[name])
+                                    for name in ('rx_in', 'rx_out', 'tx_in', 'tx_out')]
+    status_shm = attach_shared_memory(status_name)
+    status = np.ndarray(STATUS_FIELDS, dtype=np.float64, buffer=status_shm.buf)
+
+    try:
+        fdv = freedv.FreeDV(mode)
+    except Exception as e:
+        reply('error', str(e))
+        return
+
+    fdv.listen_to_analog(analog_listen)
+    reply('ready', modem_rates(fdv))
+
+    tx_frame = np.zeros(fdv.get_n_speech_samples(), dtype=np.int16)
+
+    # blocks until the bot writes something, and ends when the bot goes away
+    for line in sys.stdin:
+        status[STATUS_WAKE] = 0
+
+        if line.strip():
+            command, value = json.loads(line)
+
+            if command == 'stop':
+                break
+
+            elif command == 'set_mode':
+                try:
+                    fdv.set_mode(value)
+                except ValueError as e:
+                    reply('error', str(e))
+                    continue
+
+                # whatever is waiting was meant for the old mode
+                rx_in.clear()
+                tx_in.clear()
+                tx_frame = np.zeros(fdv.get_n_speech_samples(), dtype=np.int16)
+                reply('ready', modem_rates(fdv))
+
+            elif command == 'listen_to_analog':
+                fdv.listen_to_analog(value)
+                reply('ok')
+
+        # nin changes from frame to frame while the demodulator tracks timing
+        start = time.thread_time()
+        while rx_in.available() >= fdv.get_nin():
+            frame_errors = fdv.frame_errors
+            rx_out.write(fdv.rx(rx_in.read(fdv.get_nin(), out=fdv.rx_block)))
+
+            sync, snr = fdv.get_modem_stats()
+            status[STATUS_SYNC] = sync
+            status[STATUS_SNR] = snr
+            status[STATUS_RX_FRAMES] += 1
+            if sync:
+                status[STATUS_SYNCED_FRAMES] += 1
+
+            # counted up rather than copied, so the total carries on across a restart
+            status[STATUS_FRAME_ERRORS] += fdv.frame_errors - frame_errors
+
+            if fdv.telemetry.due():
+                status[STATUS_FOFF:STATUS_SYNC_METRIC + 1] = fdv.get_extended_stats()[2:]
+
+        status[STATUS_RX_CPU_TIME] += time.thread_time() - start
+
+        while tx_in.available() >= len(tx_frame):
+            tx_out.write(fdv.tx(tx_in.read(len(tx_frame), out=tx_frame)))
+
+    fdv.close()
+
+
+class RemoteFreeDV:
+    # Drop in replacement for freedv.FreeDV that keeps libcodec2 in a child process, so modem work
+    # never holds the bot's GIL. Output comes back one call later than with the in process modem:
+    # demodulate() and tx() hand over their input and return whatever the child has finished since
+    # the last call.
+    #
+    # A supervisor thread restarts the child if it dies (e.g. a crash inside libcodec2). Until it is
+    # back, demodulate() and tx() just return nothing, so the voice connection carries on.
+    def __init__(self, mode: str = '700D', labels: dict | None = None):
+        self.rings = {name: SharedPCMRingBuffer(capacity) for name, capacity in RINGS.items()}
+        self.rx_in = self.rings['rx_in']
+        self.rx_out = self.rings['rx_out']
+        self.tx_in = self.rings['tx_in']
+        self.tx_out = self.rings['tx_out']
+
+        self.status_shm = shared_memory.SharedMemory(create=True, size=STATUS_FIELDS * 8)
+        self.status = np.ndarray(STATUS_FIELDS, dtype=np.float64, buffer=self.status_shm.buf)
+        self.status[:] = 0
+
+        # the lock covers everything written to the child's stdin, commands wait for replies on the queue
+        self.lock = threading.Lock()
+        self.replies = queue.Queue()
+
+        self.mode = mode
+        self.analog_listen = False
+        self.speech_out = np.zeros(0, dtype=np.int16)
+        self.mod_out = np.zeros(0, dtype=np.int16)
+        self.telemetry = ModemTelemetry()
+
+        self.process = None
+        self.started = 0.0
+
+        self.restarts = metrics.registry.counter('discdv_modem_restarts_total',
+                                                 'Times the modem process was restarted after dying', labels)
+
+        self.start()
+
+        self.stopping = threading.Event()
+        self.supervisor = threading.Thread(target=self.supervise, name='modem-supervisor', daemon=True)
+        self.supervisor.start()
+
+    def start(self):
+        ring_names = {name: ring.name for name, ring in self.rings.items()}
+        args = json.dumps([self.mode, self.analog_listen, ring_names, self.status_shm.name])
+
+        process = subprocess.Popen([sys.executable, __file__, args], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   text=True, bufsize=1)
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_replies, args=(process.stdout, self.replies), name='modem-replies',
+                         daemon=True).start()
+
+        try:
+            kind, value = self.receive(START_TIMEOUT)
+        except Exception:
+            process.kill()
+            process.wait()
+            raise
+
+        if kind == 'error':
+            process.wait()
+            raise RuntimeError(f'Modem process failed to start: {value}')
+
+        self.apply_rates(value)
+        self.status[STATUS_WAKE] = 0
+        self.process = process
+        self.started = time.monotonic()
+
+    @staticmethod
+    def read_replies(stdout, replies: queue.Queue):
+        for line in stdout:
+            if line.startswith(REPLY_PREFIX):
+                replies.put(json.loads(line[len(REPLY_PREFIX):]))
+
+        replies.put(['exit', None])
+
+    def receive(self, timeout: float):
+        try:
+            kind, value = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('The modem process did not answer')
+
+        if kind == 'exit':
+            raise RuntimeError('The modem process exited')
+
+        return kind, value
+
+    def apply_rates(self, rates: dict):
+        self.speech_sample_rate = rates['speech_sample_rate']
+        self.modem_sample_rate = rates['modem_sample_rate']
+        self.n_speech_samples = rates['n_speech_samples']
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def supervise(self):
+        failures = 0
+
+        while not self.stopping.wait(0.5):
+            if self.is_alive():
+                continue
+
+            if self.process is not None:
+                print(f'FreeDV modem process exited with code {self.process.returncode}, restarting')
+                if time.monotonic() - self.started > STABLE_TIME:
+                    failures = 0
+
+                self.process = None
+                self.restarts.inc()
+
+            if self.stopping.wait(RESTART_DELAYS[min(failures, len(RESTART_DELAYS) - 1)]):
+                break
+
+            with self.lock:
+                try:
+                    self.start()
+                except Exception as e:
+                    failures += 1
+                    print(f'Error restarting the FreeDV modem process: {e}')
+
+    def send(self, line: str):
+        try:
+            self.process.stdin.write(line + '\n')
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            pass  # the child died, the supervisor will notice
+
+    def command(self, command: str, value):
+        with self.lock:
+            if not self.is_alive():
+                raise ValueError('The FreeDV modem process is restarting, try again in a moment')
+
+            self.send(json.dumps([command, value]))
+
+            try:
+                return self.receive(COMMAND_TIMEOUT)
+            except (TimeoutError, RuntimeError) as e:
+                raise ValueError(f'The FreeDV modem process did not answer: {e}')
+
+    def wake(self):
+        # at most one wake up byte is ever waiting in the pipe, so a stuck child can't fill it and block us
+        if self.status[STATUS_WAKE] or not self.is_alive():
+            return
+
+        if self.lock.acquire(blocking=False):
+            try:
+                self.status[STATUS_WAKE] = 1
+                self.send('')
+            finally:
+                self.lock.release()
+
+    @property
+    def synced(self):
+        return bool(self.status[STATUS_SYNC])
+
+    @property
+    def snr_est(self):
+        return self.status[STATUS_SNR]
+
+    @property
+    def rx_frames(self):
+        return int(self.status[STATUS_RX_FRAMES])
+
+    @property
+    def synced_frames(self):
+        return int(self.status[STATUS_SYNCED_FRAMES])
+
+    @property
+    def frame_errors(self):
+        return int(self.status[STATUS_FRAME_ERRORS])
+
+    @property
+    def rx_cpu_time(self):
+        return self.status[STATUS_RX_CPU_TIME]
+
+    def sample_telemetry(self):
+        self.telemetry.record(self.status[STATUS_SYNC], self.status[STATUS_SNR], self.status[STATUS_FOFF],
+                              self.status[STATUS_CLOCK_OFFSET], self.status[STATUS_SYNC_METRIC], self.rx_frames,
+                              self.frame_errors)
+
+    def set_mode(self, mode: str):
+        if mode not in freedv.FREEDV_MODES:
+            raise ValueError(f'Unknown FreeDV mode {mode}, choose from {", ".join(freedv.FREEDV_MODES)}')
+
+        kind, value = self.command('set_mode', mode)
+        if kind == 'error':
+            raise ValueError(value)
+
+        self.apply_rates(value)
+        self.mode = mode
+
+        # decoded speech and modulated audio from the old mode
+        self.rx_out.clear()
+        self.tx_out.clear()
+        self.telemetry.clear()
+
+    def listen_to_analog(self, val: bool):
+        self.analog_listen = val
+
+        # a restarted modem picks the setting up when it starts
+        try:
+            self.command('listen_to_analog', val)
+        except Exception as e:
+            print(f'Error setting analog listen on the FreeDV modem process: {e}')
+
+    def get_n_speech_samples(self):
+        return self.n_speech_samples
+
+    @staticmethod
+    def collect(ring: SharedPCMRingBuffer, out: np.ndarray):
+        n = ring.available()
+        if len(out) < n:
+            out = np.empty(n, dtype=np.int16)
+
+        return ring.read(n, out=out), out
+
+    def demodulate(self, samples: np.ndarray):
+        self.rx_in.write(samples)
+        self.wake()
+
+        # the child keeps the status block current, this only snapshots it into the history
+        self.telemetry.capture(samples)
+        if self.telemetry.due():
+            self.sample_telemetry()
+
+        speech, self.speech_out = self.collect(self.rx_out, self.speech_out)
+        return speech
+
+    def tx(self, speech_in: np.ndarray):
+        self.tx_in.write(speech_in)
+        self.wake()
+
+        modulated, self.mod_out = self.collect(self.tx_out, self.mod_out)
+        return modulated
+
+    def close(self):
+        self.stopping.set()
+        self.supervisor.join()
+
+        with self.lock:
+            if self.is_alive():
+                self.send(json.dumps(['stop', None]))
+
+                try:
+                    self.process.wait(COMMAND_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+
+        for ring in self.rings.values():
+            ring.close()
+
+        del self.status
+        self.status_shm.close()
+        self.status_shm.unlink()
+
+
+if __name__ == '__main__':
+    run_modem(*json.loads(sys.argv[1]))
@@ -0,0 +1,241 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+import metrics
+
+
+class StageStats:
+    def __init__(self, name: str, deadline: float, labels: dict | None = None):
+        self.name = name
+        self.deadline = deadline
+
+        self.runs = 0
+        self.misses = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+
+        self.histogram = metrics.registry.histogram('discdv_stage_seconds', 'Time spent in each DSP pipeline stage',
+                                                    {**(labels or {}), 'stage': name})
+        self.deadline_misses = metrics.registry.counter('discdv_stage_deadline_misses_total',
+                                                        'DSP pipeline stage runs that went over their deadline',
+                                                        {**(labels or {}), 'stage': name})
+
+    def record(self, duration: float):
+        self.histogram.observe(duration)
+        self.runs += 1
+        self.last = duration
+        self.total += duration
+
+        if duration > self.max:
+            self.max = duration
+
+        if duration > self.deadline:
+            self.misses += 1
+            self.deadline_misses.inc()
+
+    def __str__(self):
+        mean = self.total / self.runs if self.runs else 0.0
+        return (f'{self.name}: {self.runs} runs, mean {mean * 1000:.2f} ms, max {self.max * 1000:.2f} ms, '
+                f'{self.misses} missed {self.deadline * 1000:.1f} ms deadline')
+
+
+class PipelineStage(ABC):
+    # Anything with a name and a process() method can be a stage. deadline is the time budget for one
+    # call, None means the whole frame period. A stage without process() fails when it is created, not
+    # on the DSP thread.
+    name = 'stage'
+    deadline = None
+
+    @abstractmethod
+    def process(self):
+        pass
+
+
+class TXGate(PipelineStage):
+    # Decides when the radio is keyed from the level of the TX mix instead of from every non-zero
+    # sample. Speech has to stay above the threshold for attack seconds to key up, the radio stays
+    # keyed for hang seconds after the last speech and for at least min_key seconds in total, so
+    # comfort noise and pauses between words don't flap the relay. PTT commands are handed to the
+    # rigctld loop without waiting, and only the latest wanted state is sent once the last one is done.
+    name = 'tx_gate'
+
+    def __init__(self, sink, rig, threshold_db: float = -45.0, attack: float = 0.05, hang: float = 1.0,
+                 min_key: float = 1.0, frame_period: float = 0.128, labels: dict | None = None):
+        self.sink = sink
+        self.rig = rig
+
+        self.threshold_db = threshold_db
+        self.attack = attack
+        self.hang = hang
+        self.min_key = min_key
+        # the gate only runs once a block, so the block it sees speech in counts towards the attack in full
+        self.frame_period = frame_period
+
+        self.keyed = False
+        self.voice_start = None
+        self.last_voice = 0.0
+        self.key_time = 0.0
+
+        self.ptt = False
+        self.pending = None
+
+        self.keyups = metrics.registry.counter('discdv_ptt_keyups_total', 'Number of times the radio was keyed',
+                                               labels)
+        self.commands = metrics.registry.counter('discdv_ptt_commands_total', 'PTT commands sent to rigctld', labels)
+        self.command_errors = metrics.registry.counter('discdv_ptt_command_errors_total', 'PTT commands that failed',
+                                                       labels)
+        self.level = metrics.registry.gauge('discdv_tx_level_dbfs', 'RMS level of the TX mix', labels)
+
+    def level_db(self):
+        # the loudest frame the sink mixed since the last block
+        rms = self.sink.rms_level
+        return 20 * math.log10(rms / 32768) if rms > 0 else -math.inf
+
+    def update(self, now: float):
+        level = self.level_db()
+        self.level.set(max(level, -120.0))
+
+        voice = self.sink.tx_enabled and level > self.threshold_db
+
+        # speech that hasn't keyed the radio yet is held, so the recording includes the block that triggered it
+        if not self.keyed:
+            if voice:
+                self.sink.hold_preroll()
+            else:
+                self.sink.clear_preroll()
+
+        if voice:
+            if self.voice_start is None:
+                self.voice_start = now
+            self.last_voice = now
+        else:
+            self.voice_start = None
+
+        if not self.sink.tx_enabled:
+            self.keyed = False
+        elif not self.keyed:
+            if voice and now + self.frame_period - self.voice_start >= self.attack:
+                self.keyed = True
+                self.key_time = now
+                self.keyups.inc()
+        elif now - self.last_voice >= self.hang and now - self.key_time >= self.min_key:
+            self.keyed = False
+
+        # the sink keeps feeding the modem silence while we hang, so the transmission stays continuous
+        self.sink.keyed = self.keyed
+        return self.keyed
+
+    def send_ptt(self):
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+
+            error = self.pending.exception()
+            self.pending = None
+
+            if error:
+                self.command_errors.inc()
+                print(f'Error setting PTT: {error}')
+                # the radio is in an unknown state, send the wanted state again
+                self.ptt = not self.keyed
+
+        if self.keyed != self.ptt:
+            self.ptt = self.keyed
+            self.commands.inc()
+            self.pending = self.rig.set_ptt_nowait(self.ptt)
+
+    def process(self):
+        self.update(time.monotonic())
+        self.send_ptt()
+
+    async def release(self):
+        # only once the gate is out of the pipeline, so the DSP thread can't key up again behind us
+        self.keyed = False
+        self.sink.keyed = False
+
+        # a key up that is still in flight could land after this, so always send the unkey then
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+            self.ptt = True
+
+        if self.ptt:
+            self.ptt = False
+            self.commands.inc()
+
+            try:
+                await self.rig.set_ptt_async(False)
+            except Exception as e:
+                self.command_errors.inc()
+                print(f'Error setting PTT: {e}')
+
+
+class DSPPipeline(threading.Thread):
+    # Runs the mixing, modem and PTT work on its own thread, once per soundcard block. The audio
+    # callback only moves samples in and out of ring buffers and calls notify().
+    def __init__(self, frame_period: float, stages=(), name: str = 'dsp-pipeline', labels: dict | None = None):
+        super().__init__(name=name, daemon=True)
+        self.frame_period = frame_period
+        self.labels = labels
+        self.wakeup = threading.Event()
+        self.running = False
+
+        # held for a whole frame, so set_stages() returns only once the old stages have stopped running
+        self.frame_lock = threading.Lock()
+
+        self.frames = 0
+        self.frame_stats = StageStats('frame', frame_period, labels)
+        self.stages = []
+        self.set_stages(stages)
+
+    def set_stages(self, stages):
+        # swapped in as a single list so the pipeline thread never sees a half updated set of stages. waits out
+        # a frame in progress, so call it off the event loop
+        stages = [(stage, StageStats(stage.name, stage.deadline or self.frame_period, self.labels))
+                  for stage in stages]
+
+        with self.frame_lock:
+            self.stages = stages
+
+    def notify(self):
+        self.wakeup.set()
+
+    def run(self):
+        self.running = True
+
+        while self.running:
+            # fall back to our own clock if the soundcard stops calling back
+            self.wakeup.wait(self.frame_period)
+            self.wakeup.clear()
+
+            if self.running:
+                self.run_frame()
+
+    def run_frame(self):
+        frame_start = time.perf_counter()
+
+        with self.frame_lock:
+            for stage, stats in self.stages:
+                start = time.perf_counter()
+
+                try:
+                    stage.process()
+                except Exception as e:
+                    print(f'Error in DSP stage {stage.name}: {e}')
+
+                stats.record(time.perf_counter() - start)
+
+        self.frames += 1
+        self.frame_stats.record(time.perf_counter() - frame_start)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+        if self.is_alive():
+            self.join()
+
+    def get_stats(self):
+        return [self.frame_stats] + [stats for stage, stats in self.stages]
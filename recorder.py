@@ -0,0 +1,231 @@
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import wave
+import numpy as np
+import metrics
+
+try:
+    import soundfile
+    HAVE_SOUNDFILE = True
+except ImportError:
+    HAVE_SOUNDFILE = False
+
+# format name: (file extension, soundfile format, soundfile subtype)
+FORMATS = {
+    'wav': ('wav', None, None),
+    'flac': ('flac', 'FLAC', 'PCM_16'),
+    'opus': ('opus', 'OGG', 'OPUS'),
+}
+
+
+class SegmentFile:
+    # One recording file plus its metadata, written out as a .json file next to it when it is closed
+    def __init__(self, path: str, file_format: str, rate: int, metadata: dict, session: int | None = None,
+                 dropped_at_start: int = 0):
+        self.path = path
+        self.rate = rate
+        self.metadata = metadata
+        self.session = session
+        self.dropped_at_start = dropped_at_start
+        self.started = time.time()
+        self.frames = 0
+
+        sf_format, sf_subtype = FORMATS[file_format][1:]
+
+        if sf_format:
+            self.file = soundfile.SoundFile(path, 'w', samplerate=rate, channels=1, format=sf_format,
+                                            subtype=sf_subtype)
+            self.wav = False
+        else:
+            self.file = wave.open(path, 'wb')
+            self.file.setnchannels(1)
+            self.file.setsampwidth(2)
+            self.file.setframerate(rate)
+            self.wav = True
+
+    def write(self, samples: np.ndarray):
+        if self.wav:
+            self.file.writeframes(samples.tobytes())
+        else:
+            self.file.write(samples)
+
+        self.frames += len(samples)
+
+    def age(self):
+        return time.time() - self.started
+
+    def close(self, **metadata):
+        self.file.close()
+
+        self.metadata.update(metadata)
+        self.metadata['end'] = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        self.metadata['duration'] = round(self.frames / self.rate, 2)
+
+        with open(os.path.splitext(self.path)[0] + '.json', 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+
+class QSORecorder:
+    # Records the decoded RX audio and the TX mix to segmented files. The DSP thread only copies blocks
+    # into a bounded queue, a writer thread does all the file I/O. When the queue is full (the disk can't
+    # keep up) blocks are dropped and counted, the audio path never waits.
+    #
+    # RX is split into a new file every segment_minutes. TX gets a new file for every PTT session, tagged
+    # with the callsigns of the operators that were talking, and is also split if a session runs longer.
+    def __init__(self, directory: str, file_format: str = 'wav', segment_minutes: float = 30, rig_state=None,
+                 callsign_lookup=None, queue_blocks: int = 256, labels: dict | None = None):
+        if file_format not in FORMATS:
+            raise ValueError(f'Unknown recording format {file_format}, expected one of {", ".join(FORMATS)}')
+
+        if file_format != 'wav' and not HAVE_SOUNDFILE:
+            print(f'soundfile is not installed, recording to wav instead of {file_format}')
+            file_format = 'wav'
+
+        self.directory = directory
+        self.file_format = file_format
+        self.segment_seconds = segment_minutes * 60
+        self.rig_state = rig_state
+        self.callsign_lookup = callsign_lookup
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=queue_blocks)
+        self.segments = {}
+        self.callsigns = {}
+
+        self.dropped = metrics.registry.counter('discdv_recorder_dropped_blocks_total',
+                                                'Audio blocks the recorder dropped because the disk fell behind',
+                                                labels)
+        self.written = metrics.registry.counter('discdv_recorder_samples_total', 'Samples written to recordings',
+                                                labels)
+        metrics.registry.sampled('discdv_recorder_queue_blocks', 'Audio blocks waiting to be written',
+                                 self.queue.qsize, labels)
+
+        self.writer = threading.Thread(target=self.run_writer, name='qso-recorder', daemon=True)
+        self.writer.start()
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped.inc()
+
+    def rx(self, samples: np.ndarray, rate: int):
+        # the caller's buffers are reused every block, so the samples have to be copied
+        self.put(('rx', samples.copy(), rate, None))
+
+    def tx(self, samples: np.ndarray, rate: int, user_ids=(), session: int = 0):
+        # a new session number starts a new file even if the end_tx before it was dropped
+        self.put(('tx', samples.copy(), rate, (session, tuple(user_ids))))
+
+    def end_tx(self):
+        self.put(('end', None, None, 'tx'))
+
+    def close(self):
+        # the writer drains whatever is left, then stops at the sentinel
+        try:
+            self.queue.put(None, timeout=5)
+        except queue.Full:
+            pass
+
+        self.writer.join()
+
+    def run_writer(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                item = ('tick', None, None, None)
+
+            if item is None:
+                break
+
+            try:
+                self.handle(*item)
+            except Exception as e:
+                print(f'Error writing recording: {e}')
+
+        for stream in list(self.segments):
+            self.close_segment(stream)
+
+    def handle(self, stream: str, samples, rate, extra):
+        if stream == 'end':
+            self.close_segment(extra)
+            return
+
+        if stream == 'tick':
+            for name, segment in list(self.segments.items()):
+                if segment.age() >= self.segment_seconds:
+                    self.close_segment(name)
+            return
+
+        session, user_ids = extra or (None, ())
+        segment = self.segments.get(stream)
+
+        # a mode change can change the speech rate, and wav can't change rate midway
+        if segment and (segment.rate != rate or segment.session != session or
+                        segment.age() >= self.segment_seconds):
+            self.close_segment(stream)
+            segment = None
+
+        if segment is None:
+            segment = self.open_segment(stream, rate, session)
+
+        # a dict rather than a set keeps the operators in the order they first spoke
+        self.callsigns[stream].update((user_id, None) for user_id in user_ids)
+
+        segment.write(samples)
+        self.written.inc(len(samples))
+
+    def rig_metadata(self):
+        if self.rig_state is None or not self.rig_state.updated:
+            return {}
+
+        return {'freq': self.rig_state.freq, 'mode': self.rig_state.mode}
+
+    def open_segment(self, stream: str, rate: int, session: int | None):
+        now = datetime.datetime.now().astimezone()
+        extension = FORMATS[self.file_format][0]
+        name = f'{now.strftime("%Y%m%d-%H%M%S")}_{stream}'
+
+        # two short overs can start within the same second
+        path = os.path.join(self.directory, f'{name}.{extension}')
+        n = 1
+        while os.path.exists(path):
+            n += 1
+            path = os.path.join(self.directory, f'{name}_{n}.{extension}')
+
+        metadata = {'stream': stream, 'start': now.isoformat(timespec='seconds'), 'rate': rate,
+                    **self.rig_metadata()}
+
+        segment = SegmentFile(path, self.file_format, rate, metadata, session, self.dropped.value)
+        self.segments[stream] = segment
+        self.callsigns[stream] = {}
+        return segment
+
+    def close_segment(self, stream: str):
+        segment = self.segments.pop(stream, None)
+        if segment is None:
+            return
+
+        callsigns = []
+        for user_id in self.callsigns.pop(stream, {}):
+            callsign = self.callsign_lookup(user_id) if self.callsign_lookup else None
+            callsigns.append(callsign or str(user_id))
+
+        metadata = {'dropped_blocks': self.dropped.value - segment.dropped_at_start}
+        if callsigns:
+            metadata['operators'] = callsigns
+
+        # the frequency can change during a segment, keep what it ended on too
+        rig_end = self.rig_metadata()
+        if rig_end and (rig_end.get('freq') != segment.metadata.get('freq') or
+                        rig_end.get('mode') != segment.metadata.get('mode')):
+            metadata['end_freq'] = rig_end['freq']
+            metadata['end_mode'] = rig_end['mode']
+
+        segment.close(**metadata)
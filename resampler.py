@@ -0,0 +1,88 @@
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def design_lowpass(ntaps: int, cutoff: float, beta: float = 8.0):
+    # windowed sinc, cutoff is in cycles per sample at the filter's (higher) sample rate
+    n = np.arange(ntaps) - (ntaps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(ntaps, beta)
+    return h / h.sum()
+
+
+class StreamingResampler:
+    # Integer ratio polyphase resampler that keeps its filter history between calls,
+    # so consecutive chunks join up without edge artifacts.
+    TAPS_PER_PHASE = 24
+    LOW_LATENCY_TAPS_PER_PHASE = 8
+
+    def __init__(self, in_rate: int, out_rate: int, low_latency: bool = False):
+        if in_rate % out_rate and out_rate % in_rate:
+            raise ValueError(f'Only integer resampling ratios are supported, got {in_rate} -> {out_rate}')
+
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.up = max(out_rate // in_rate, 1)
+        self.down = max(in_rate // out_rate, 1)
+        self.factor = max(self.up, self.down)
+
+        taps_per_phase = self.LOW_LATENCY_TAPS_PER_PHASE if low_latency else self.TAPS_PER_PHASE
+        self.ntaps = taps_per_phase * self.factor
+
+        # leave a little room below nyquist of the low rate for the transition band
+        h = design_lowpass(self.ntaps, 0.45 / self.factor).astype(np.float32)
+
+        if self.up > 1:
+            # phases[p, k] = h[k * up + p], stored reversed so each row is a plain dot product
+            self.phases = (h.reshape(taps_per_phase, self.up).T[:, ::-1] * self.up).copy()
+            self.history_len = taps_per_phase - 1
+        else:
+            self.taps = h[::-1].copy()
+            self.history_len = self.ntaps - 1
+
+        self.history = np.zeros(self.history_len, dtype=np.float32)
+        self.last_process_time = 0.0
+
+    @property
+    def latency(self):
+        # group delay of the linear phase FIR, in seconds
+        return (self.ntaps - 1) / 2 / max(self.in_rate, self.out_rate)
+
+    def reset(self):
+        self.history = np.zeros(self.history_len, dtype=np.float32)
+
+    def process(self, samples: np.ndarray):
+        start = time.perf_counter()
+
+        buf = np.concatenate((self.history, samples.astype(np.float32)))
+
+        if self.up > 1:
+            output = self.upsample(buf)
+        else:
+            output = self.downsample(buf)
+
+        np.rint(output, out=output)
+        np.clip(output, -32768, 32767, out=output)
+        output = output.astype(np.int16)
+
+        self.last_process_time = time.perf_counter() - start
+        return output
+
+    def upsample(self, buf: np.ndarray):
+        windows = sliding_window_view(buf, self.history_len + 1)
+
+        output = (windows @ self.phases.T).reshape(-1)
+        self.history = buf[len(buf) - self.history_len:].copy()
+        return output
+
+    def downsample(self, buf: np.ndarray):
+        if len(buf) < self.ntaps:
+            self.history = buf
+            return np.zeros(0, dtype=np.float32)
+
+        windows = sliding_window_view(buf, self.ntaps)[::self.down]
+        output = windows @ self.taps
+
+        # whatever has not been consumed by a full output step carries over to the next call
+        self.history = buf[len(windows) * self.down:].copy()
+        return output
@@ -1,74 +1,291 @@
-import socket
+import asyncio
+import threading
+import time
 import subprocess
 import shlex
 import platform
+import metrics
+
+# longest wait between polls while rigctld can't be reached
+MAX_POLL_BACKOFF = 30.0
+
+
+class RigError(Exception):
+    pass
+
+
+class RigState:
+    # last known radio state, filled in by polling and by successful set commands
+    def __init__(self):
+        self.freq: int | None = None
+        self.mode: str | None = None
+        self.passband: int | None = None
+        self.ptt = False
+        self.updated = 0.0
+
+    def update(self, **values):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+        self.updated = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.updated if self.updated else None
+
+
+class AsyncRigClient:
+    # rigctld answers most commands with a single line, these send more than one
+    REPLY_LINES = {'m': 2}
+
+    def __init__(self, host: str = 'localhost', port: int = 4532, timeout: float = 2.0, labels: dict | None = None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.lock = asyncio.Lock()
+        self.state = RigState()
+
+        self.command_time = metrics.registry.histogram('discdv_rig_command_seconds',
+                                                       'Round trip time of a batch of rigctld commands', labels)
+        self.errors = metrics.registry.counter('discdv_rig_errors_total', 'rigctld commands that failed or timed out',
+                                               labels)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass  # the connection was already broken
+
+    async def pipeline(self, *commands: str, timeout: float | None = None):
+        # all commands go out in one write and the replies are read back in order, so a batch
+        # costs a single round trip to rigctld
+        timeout = timeout or self.timeout
+        start = time.perf_counter()
+
+        async with self.lock:
+            # the connection was dropped after an error, try it again now
+            if self.writer is None:
+                await self.connect()
+
+            replies = []
+            try:
+                self.writer.write(''.join(f'{command}\n' for command in commands).encode())
+                await self.writer.drain()
+
+                for command in commands:
+                    replies.append(await self.read_reply(command, timeout))
+
+            except asyncio.TimeoutError:
+                # whatever rigctld sends late would be read as the reply to the next command
+                self.errors.inc()
+                await self.close()
+                raise RigError(f'Timed out waiting for rigctld to answer {commands}')
+
+            except OSError:
+                self.errors.inc()
+                await self.close()
+                raise
+
+        self.command_time.observe(time.perf_counter() - start)
+
+        # only raise once every reply of the batch has been read, so the stream stays in step
+        for command, lines in zip(commands, replies):
+            if lines[0].startswith('RPRT') and lines[0] != 'RPRT 0':
+                self.errors.inc()
+                raise RigError(f'rigctld returned {lines[0]} for {command}')
+
+        return replies
+
+    async def read_reply(self, command: str, timeout: float):
+        lines = []
+
+        for i in range(self.REPLY_LINES.get(command.split(' ')[0], 1)):
+            line = (await asyncio.wait_for(self.reader.readline(), timeout)).decode().strip()
+            lines.append(line)
+
+            if line.startswith('RPRT'):
+                break
+
+        return lines
+
+    async def command(self, command: str, timeout: float | None = None):
+        return (await self.pipeline(command, timeout=timeout))[0]
+
+    async def set_ptt(self, value: bool):
+        ptt = 1 if value else 0
+        reply = (await self.command(f'T {ptt}'))[0]
+        self.state.update(ptt=value)
+        return reply
+
+    async def get_ptt(self):
+        ptt = bool(int((await self.command('t'))[0]))
+        self.state.update(ptt=ptt)
+        return ptt
+
+    async def get_freq(self):
+        freq = int((await self.command('f'))[0])
+        self.state.update(freq=freq)
+        return freq
+
+    async def set_freq(self, freq: int):
+        reply = (await self.command(f'F {freq}'))[0]
+        self.state.update(freq=freq)
+        return reply
+
+    async def get_mode(self):
+        lines = await self.command('m')
+        self.state.update(mode=lines[0], passband=int(lines[1]))
+        return lines[0]
+
+    async def set_mode(self, mode: str, passband: int):
+        reply = (await self.command(f'M {mode} {passband}'))[0]
+        self.state.update(mode=mode, passband=passband if passband > 0 else None)
+        return reply
+
+    async def poll_state(self, interval: float):
+        # rigctld has no change notifications on its command socket, so frequency, mode and PTT are
+        # fetched together in one pipelined round trip every interval
+        delay = interval
+
+        while True:
+            try:
+                freq, mode, ptt = await self.pipeline('f', 'm', 't')
+                self.state.update(freq=int(freq[0]), mode=mode[0], passband=int(mode[1]), ptt=bool(int(ptt[0])))
+                delay = interval
+
+            except (RigError, ValueError, IndexError) as e:
+                print(f'Error polling rig state: {e}')
+
+            except OSError as e:
+                # keep trying, backing off while rigctld is gone, instead of leaving the cached state to go stale
+                delay = min(delay * 2, max(MAX_POLL_BACKOFF, interval))
+                print(f'Lost the connection to rigctld while polling, retrying in {delay:.1f} s: {e}')
+
+            await asyncio.sleep(delay)
 
 
 class RigControl:
-    def __init__(self, rigctld_cmd):
+    # Owns the rigctld process and an AsyncRigClient running on its own event loop thread. Every
+    # caller, the DSP thread keying PTT or a slash command, goes through that one loop, so commands
+    # are serialized without blocking the discord event loop.
+    def __init__(self, rigctld_cmd: str | None, port: int = 4532, poll_interval: float | None = None,
+                 start_timeout: float = 10.0, labels: dict | None = None):
         system = platform.system()
         self.rigctld = None
 
-        if system == 'Linux':
-            self.rigctld = subprocess.Popen(shlex.split(rigctld_cmd))
-        elif system == 'Windows':
-            self.rigctld = subprocess.Popen(rigctld_cmd)
+        # with no command, attach to a rigctld that is already listening on the port
+        if rigctld_cmd:
+            if system == 'Linux':
+                self.rigctld = subprocess.Popen(shlex.split(rigctld_cmd))
+            elif system == 'Windows':
+                self.rigctld = subprocess.Popen(rigctld_cmd)
 
-        assert isinstance(self.rigctld, subprocess.Popen)
+            assert isinstance(self.rigctld, subprocess.Popen)
 
-        self.rigctld_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.rigctld_socket.connect(('localhost', 4532))
-        self.busy = False
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='rigctld', daemon=True)
+        self.loop_thread.start()
 
-    def close(self):
-        while self.busy:
-            pass
+        self.client = AsyncRigClient('localhost', port, labels=labels)
+        self.state = self.client.state
+        self.poller = None
 
-        self.rigctld_socket.close()
-        self.rigctld.terminate()
+        try:
+            self.wait_for_rigctld(start_timeout)
+        except Exception:
+            self.close()
+            raise
 
-    def receive_line(self, decode: bool = True):
-        recv_data = b''
-        self.busy = True
+        self.poller = self.submit(self.client.poll_state(poll_interval)) if poll_interval else None
+
+    def wait_for_rigctld(self, timeout: float):
+        # a freshly started rigctld takes a moment to open its port, keep trying with backoff until it does
+        deadline = time.monotonic() + timeout
+        delay = 0.05
 
         while True:
-            data = self.rigctld_socket.recv(1)
-            recv_data += data
+            try:
+                return self.run(self.client.connect())
+            except OSError:
+                if self.rigctld and self.rigctld.poll() is not None:
+                    raise RigError(f'rigctld exited with code {self.rigctld.returncode}')
 
-            if data.decode() == '\n':
-                break
+                if time.monotonic() + delay > deadline:
+                    raise
 
-        self.busy = False
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
 
-        return recv_data.decode() if decode else recv_data
+    def close(self):
+        if self.poller:
+            self.poller.cancel()
+
+        self.run(self.client.close())
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+        if self.rigctld:
+            self.rigctld.terminate()
+
+            try:
+                self.rigctld.wait(5)
+            except subprocess.TimeoutExpired:
+                self.rigctld.kill()
+                self.rigctld.wait()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    async def run_async(self, coro):
+        return await asyncio.wrap_future(self.submit(coro))
 
     def set_ptt(self, value: bool):
-        ptt = 1 if value else 0
-        self.rigctld_socket.send(f'T {ptt}\n'.encode())
-        return self.receive_line()
+        return self.run(self.client.set_ptt(value))
+
+    async def set_ptt_async(self, value: bool):
+        return await self.run_async(self.client.set_ptt(value))
+
+    def set_ptt_nowait(self, value: bool):
+        # for the DSP thread, returns the future instead of waiting on the radio
+        return self.submit(self.client.set_ptt(value))
 
     def get_ptt(self):
-        self.rigctld_socket.send('t\n'.encode())
-        return bool(int(self.receive_line()))
+        return self.run(self.client.get_ptt())
 
     def get_freq(self):
-        self.rigctld_socket.send('f\n'.encode())
-        return int(self.receive_line())
+        return self.run(self.client.get_freq())
 
     def set_freq(self, freq: int):
-        self.rigctld_socket.send(f'F {freq}\n'.encode())
-        return self.receive_line()
+        return self.run(self.client.set_freq(freq))
 
     def get_mode(self):
-        self.rigctld_socket.send('m\n'.encode())
-        recv = self.receive_line()
-        # recv_split = recv.split(' ')
-        # mode = recv_split[0]
-        # passband = int(recv_split[1])
-        #
-        # return mode, passband
-        return recv
+        return self.run(self.client.get_mode())
 
     def set_mode(self, mode: str, passband: int):
-        self.rigctld_socket.send(f'M {mode} {passband}\n'.encode())
-        return self.receive_line()
+        return self.run(self.client.set_mode(mode, passband))
+
+    async def set_freq_async(self, freq: int):
+        return await self.run_async(self.client.set_freq(freq))
+
+    async def get_freq_async(self):
+        return await self.run_async(self.client.get_freq())
+
+    async def set_mode_async(self, mode: str, passband: int):
+        return await self.run_async(self.client.set_mode(mode, passband))
+
+    async def get_mode_async(self):
+        return await self.run_async(self.client.get_mode())
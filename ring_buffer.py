@@ -0,0 +1,133 @@
+import sys
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+
+class PCMRingBuffer:
+    # Single producer / single consumer ring of int16 samples. The producer only ever advances
+    # write_pos and the consumer only ever advances read_pos, so no lock is needed between them.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+
+        self.write_pos = 0
+        self.read_pos = 0
+
+        self.overflows = 0
+        self.underruns = 0
+        self.dropped_samples = 0
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+    def free(self):
+        return self.capacity - self.available()
+
+    def fill_level(self):
+        return self.available() / self.capacity
+
+    def write(self, samples: np.ndarray):
+        n = len(samples)
+        free = self.free()
+
+        if n > free:
+            self.overflows += 1
+            self.dropped_samples += n - free
+            samples = samples[:free]
+            n = free
+
+        if n == 0:
+            return 0
+
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+
+        self.write_pos += n
+        return n
+
+    def read(self, n: int, out: np.ndarray | None = None):
+        if self.available() < n:
+            self.underruns += 1
+            return None
+
+        if out is None:
+            out = np.empty(n, dtype=np.int16)
+
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+
+        out[:first] = self.buffer[start:start + first]
+        out[first:n] = self.buffer[:n - first]
+
+        self.read_pos += n
+        return out[:n]
+
+    def discard(self, n: int):
+        n = min(n, self.available())
+        self.read_pos += n
+        return n
+
+    def clear(self):
+        self.read_pos = self.write_pos
+
+
+def attach_shared_memory(name: str):
+    # only the process that created a block may unlink it. before python 3.13 attaching registers the block
+    # with this process's resource tracker, which would unlink it as soon as this process exits
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedPCMRingBuffer(PCMRingBuffer):
+    # The same ring kept in a multiprocessing.shared_memory block, so the producer and consumer can be in
+    # different processes. The block starts with the write and read positions, followed by the samples.
+    # Created without a name it allocates a new block, with a name it attaches to an existing one.
+    def __init__(self, capacity: int, name: str | None = None):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=16 + capacity * 2)
+        else:
+            self.shm = attach_shared_memory(name)
+        self.name = self.shm.name
+        self.capacity = capacity
+
+        self.positions = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        self.buffer = np.ndarray(capacity, dtype=np.int16, buffer=self.shm.buf, offset=16)
+
+        if self.owner:
+            self.positions[:] = 0
+
+        self.overflows = 0
+        self.underruns = 0
+        self.dropped_samples = 0
+
+    @property
+    def write_pos(self):
+        return int(self.positions[0])
+
+    @write_pos.setter
+    def write_pos(self, value: int):
+        self.positions[0] = value
+
+    @property
+    def read_pos(self):
+        return int(self.positions[1])
+
+    @read_pos.setter
+    def read_pos(self, value: int):
+        self.positions[1] = value
+
+    def close(self):
+        # the numpy views have to go before the block can be closed
+        del self.positions, self.buffer
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
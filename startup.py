@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+
+
+class Startup:
+    # Starts independent components at the same time on a thread pool. A component can wait for another
+    # one it needs with result(). If a component that is required fails, everything that did start is
+    # shut down again in reverse order and the error is raised, so the bot never half starts.
+    def __init__(self):
+        self.components = []
+        self.order = {}
+        self.futures = {}
+        self.timings = {}
+        self.started = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, start, stop=None, required: bool = True):
+        self.order[name] = len(self.components)
+        self.components.append((name, start, stop, required))
+        self.futures[name] = Future()
+
+    def result(self, name: str):
+        return self.futures[name].result()
+
+    def run_component(self, name: str, start, stop, required: bool):
+        begin = time.perf_counter()
+
+        try:
+            value = start()
+        except Exception as e:
+            self.timings[name] = time.perf_counter() - begin
+            self.futures[name].set_exception(e)
+
+            if required:
+                raise
+            return None
+
+        self.timings[name] = time.perf_counter() - begin
+        metrics.registry.gauge('discdv_startup_seconds', 'Time each component took to start',
+                               {'component': name}).set(self.timings[name])
+
+        with self.lock:
+            self.started.append((self.order[name], name, value, stop))
+
+        self.futures[name].set_result(value)
+        return value
+
+    def run(self):
+        begin = time.perf_counter()
+
+        # one thread each, so a component waiting on another can never starve the pool
+        with ThreadPoolExecutor(max_workers=len(self.components), thread_name_prefix='startup') as executor:
+            futures = [executor.submit(self.run_component, *component) for component in self.components]
+
+            error = None
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    error = error or e
+
+        self.report(time.perf_counter() - begin)
+
+        if error:
+            self.shutdown()
+            raise error
+
+        return {name: future.result() for name, future in self.futures.items() if future.exception() is None}
+
+    def report(self, total: float):
+        timings = ', '.join(f'{name} {duration * 1000:.0f} ms' for name, duration in
+                            sorted(self.timings.items(), key=lambda item: -item[1]))
+        print(f'Started in {total:.2f} s ({timings})')
+
+    def shutdown(self):
+        # the reverse of the order components were added in, not the order they happened to finish
+        for index, name, value, stop in sorted(self.started, key=lambda item: item[0], reverse=True):
+            if stop is None:
+                continue
+
+            try:
+                stop(value)
+            except Exception as e:
+                print(f'Error shutting down {name}: {e}')
+
+        self.started.clear()
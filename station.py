@@ -0,0 +1,270 @@
+import asyncio
+import os
+import time
+import discord
+import numpy as np
+import pyaudio
+import audio
+import config
+import freedv
+import metrics
+import rig_control
+from jitter import TXBuffer
+from modem_process import RemoteFreeDV
+from pipeline import DSPPipeline, TXGate
+from recorder import QSORecorder
+from ring_buffer import PCMRingBuffer
+
+# every setting a rig can override in config.rigs, anything left out comes from the top level of config.py
+STATION_SETTINGS = ['audio_input_device', 'audio_output_device', 'tx_volume', 'rx_jitter_target_ms',
+                    'tx_jitter_target_ms', 'tx_speaker_jitter_ms', 'tx_vad_threshold_db', 'tx_attack_ms', 'tx_hang_ms', 'tx_min_key_ms',
+                    'freedv_mode', 'freedv_rx_modes', 'rigctld_cmd', 'rigctld_port', 'default_freq', 'default_mode',
+                    'rigctld_start_timeout', 'rig_poll_interval', 'modem_process', 'soundcard_rate']
+
+
+def load_station_settings():
+    defaults = {name: getattr(config, name) for name in STATION_SETTINGS if hasattr(config, name)}
+    defaults.setdefault('rigctld_port', 4532)
+    defaults.setdefault('rigctld_start_timeout', 10.0)
+    defaults.setdefault('soundcard_rate', 8000)
+    defaults.setdefault('tx_speaker_jitter_ms', 100)
+
+    # older configs only describe one radio at the top level
+    rigs = getattr(config, 'rigs', None) or {'default': {}}
+
+    return {name: {**defaults, **settings} for name, settings in rigs.items()}
+
+
+async def on_voice_leave(sink: discord.sinks, channel: discord.TextChannel, *args):
+    await sink.vc.disconnect()
+
+
+class Station:
+    # Everything one radio needs: its rigctld, soundcard stream, FreeDV codec, buffers, DSP thread and
+    # the voice channel it is connected to. Each station runs independently of the others.
+    #
+    # Starting is split into load_codec(), start_rig() and start_audio(), which don't depend on each
+    # other and run at the same time at startup, then start() once all of them are done.
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.settings = settings
+        self.bot_db = None
+        self.labels = {'rig': name}
+
+        self.vc: discord.VoiceClient | None = None
+        self.sink: audio.FreeDVSink | None = None
+        self.source: audio.FreeDVSource | None = None
+        self.tx_gate: TXGate | None = None
+        self.tx_volume = settings['tx_volume']
+        self.use_freedv = False
+
+        self.fdv = None
+        self.rx_fdv = None
+        self.rig: rig_control.RigControl | None = None
+        self.stream = None
+        self.recorder = None
+
+        # 8 kHz, or 48 kHz so analog audio never has to be resampled. blocks are 128 ms either way
+        self.rate = settings['soundcard_rate']
+        if self.rate not in (8000, 48000):
+            raise ValueError(f'soundcard_rate for {name} must be 8000 or 48000, not {self.rate}')
+        self.block_samples = 1024 * self.rate // 8000
+
+        # a few seconds of audio from the radio, plenty of headroom for a late modem frame. audio to the radio
+        # is made on the soundcard's clock, bursty discord audio is smoothed out per speaker before the mixer
+        self.rx_buffer = PCMRingBuffer(self.rate * 4)
+        self.tx_buffer = TXBuffer(self.rate, settings['tx_jitter_target_ms'])
+
+        # mixing, FreeDV and PTT all run here, once per soundcard block
+        self.pipeline = DSPPipeline(self.block_samples / self.rate, name=f'dsp-{name}', labels=self.labels)
+
+        self.callback_time = metrics.registry.histogram('discdv_pa_callback_seconds',
+                                                        'Time spent in the PortAudio callback', self.labels)
+        self.xruns = metrics.registry.counter('discdv_soundcard_xruns_total',
+                                              'PortAudio callbacks reporting an input or output over/underflow',
+                                              self.labels)
+
+    def load_codec(self):
+        # analog only radios never load libcodec2 at all
+        if not self.settings['freedv_mode']:
+            print(f'[{self.name}] FreeDV is turned off, analog only')
+            return
+
+        print(f'[{self.name}] Loading FreeDV...')
+        try:
+            # in its own process libcodec2 can't hold up discord's threads, and a crash in it only restarts the modem
+            modem = RemoteFreeDV if self.settings['modem_process'] else freedv.FreeDV
+            self.fdv = modem(self.settings['freedv_mode'], self.labels)
+            self.rx_fdv = (freedv.MultiModeReceiver(self.settings['freedv_rx_modes'], modem, self.labels)
+                           if self.settings['freedv_rx_modes'] else self.fdv)
+            self.use_freedv = True
+        except Exception as e:
+            print('Error loading FreeDV! Make sure all codec2 .dll / .so files are built correctly and in the lib '
+                  'directory.')
+            print('Continuing to start without FreeDV capability! This may cause bugs!')
+
+    def start_rig(self):
+        print(f'[{self.name}] Loading rigctld...')
+        try:
+            self.rig = rig_control.RigControl(self.settings['rigctld_cmd'], self.settings['rigctld_port'],
+                                              poll_interval=self.settings['rig_poll_interval'],
+                                              start_timeout=self.settings['rigctld_start_timeout'],
+                                              labels=self.labels)
+        except Exception as e:
+            print(f'Error loading rigctld for {self.name}! '
+                  f'Ensure the rigctld command and port in config.py are correct.')
+            raise e
+
+        self.rig.set_mode(self.settings['default_mode'], -1)
+        self.rig.set_freq(self.settings['default_freq'] * 1000)
+
+    def start_audio(self, pa: pyaudio.PyAudio):
+        input_device_name = pa.get_device_info_by_index(self.settings['audio_input_device'])['name']
+        output_device_name = pa.get_device_info_by_index(self.settings['audio_output_device'])['name']
+
+        print(f'[{self.name}] Starting audio at {self.rate} Hz using input device [{input_device_name}] '
+              f'and output device [{output_device_name}]')
+        try:
+            self.stream = pa.open(rate=self.rate, channels=1, format=pyaudio.paInt16, input=True, output=True,
+                                  frames_per_buffer=self.block_samples, stream_callback=self.pa_callback,
+                                  input_device_index=self.settings['audio_input_device'],
+                                  output_device_index=self.settings['audio_output_device'])
+        except Exception as e:
+            print('Error starting audio! Ensure the input and output devices are correctly configured in config.py')
+            raise e
+
+    def start(self, bot_db):
+        self.bot_db = bot_db
+
+        if config.recording_dir:
+            # each radio records into its own directory once there is more than one
+            directory = (config.recording_dir if self.name == 'default'
+                         else os.path.join(config.recording_dir, self.name))
+            self.recorder = QSORecorder(directory, config.recording_format, config.recording_segment_minutes,
+                                        self.rig.state, bot_db.get_callsign, labels=self.labels)
+
+        self.pipeline.start()
+        self.register_metrics()
+
+    def pa_callback(self, in_data, frame_count, time_info, status):
+        start = time.perf_counter()
+        if status:
+            self.xruns.inc()
+
+        tx_mod = b'\x00\x00' * frame_count
+        if self.sink is not None:
+            self.rx_buffer.write(np.frombuffer(in_data, dtype=np.int16))
+
+            tx_block = self.tx_buffer.read(frame_count)
+            if tx_block is not None:
+                tx_mod = tx_block.tobytes()
+
+        self.pipeline.notify()
+
+        self.callback_time.observe(time.perf_counter() - start)
+        return tx_mod, pyaudio.paContinue
+
+    def register_metrics(self):
+        # sampled only when the metrics are read, nothing extra happens on the audio path
+        for name, buffer in [('rx', self.rx_buffer), ('tx', self.tx_buffer)]:
+            labels = {**self.labels, 'buffer': name}
+            metrics.registry.sampled('discdv_buffer_fill_ratio', 'How full each audio buffer is', buffer.fill_level,
+                                     labels)
+            metrics.registry.sampled('discdv_buffer_overflows_total', 'Writes that did not fit in the buffer',
+                                     lambda b=buffer: b.overflows, labels, 'counter')
+            metrics.registry.sampled('discdv_buffer_underruns_total', 'Reads that found too little audio in the buffer',
+                                     lambda b=buffer: b.underruns, labels, 'counter')
+
+        playout = {**self.labels, 'buffer': 'playout'}
+        metrics.registry.sampled('discdv_buffer_fill_ratio', 'How full each audio buffer is',
+                                 lambda: self.source.playout_buffer.fill_level() if self.source else 0.0, playout)
+        metrics.registry.sampled('discdv_buffer_overflows_total', 'Writes that did not fit in the buffer',
+                                 lambda: self.source.playout_buffer.overflows if self.source else 0, playout, 'counter')
+
+        tx, rx = {**self.labels, 'direction': 'tx'}, {**self.labels, 'direction': 'rx'}
+        metrics.registry.sampled('discdv_jitter_latency_seconds', 'Audio currently held in each jitter buffer',
+                                 self.tx_buffer.latency, tx)
+        metrics.registry.sampled('discdv_jitter_latency_seconds', 'Audio currently held in each jitter buffer',
+                                 lambda: self.source.playout_buffer.latency() if self.source else 0.0, rx)
+        metrics.registry.sampled('discdv_jitter_ratio', 'Drift correction resampling ratio of each jitter buffer',
+                                 lambda: self.source.playout_buffer.ratio if self.source else 1.0, rx)
+
+        if self.rx_fdv:
+            metrics.registry.sampled('discdv_modem_sync', 'Whether the FreeDV demodulator has sync',
+                                     lambda: int(self.rx_fdv.synced), self.labels)
+            metrics.registry.sampled('discdv_modem_snr_db', 'FreeDV demodulator SNR estimate',
+                                     lambda: self.rx_fdv.snr_est, self.labels)
+            metrics.registry.sampled('discdv_modem_freq_offset_hz', 'FreeDV demodulator frequency offset estimate',
+                                     lambda: self.rx_fdv.telemetry.latest('foff'), self.labels)
+            metrics.registry.sampled('discdv_modem_frame_errors_total',
+                                     'Received FreeDV frames with uncorrected bit errors',
+                                     lambda: self.rx_fdv.frame_errors, self.labels, 'counter')
+
+    async def join(self, channel: discord.VoiceChannel, text_channel: discord.TextChannel):
+        self.sink = audio.FreeDVSink(self.tx_buffer, self.bot_db.operators, self.fdv, self.recorder, self.rate,
+                                     self.settings['tx_speaker_jitter_ms'])
+        self.sink.set_tx_volume(self.tx_volume)
+        self.sink.set_transmit_freedv(self.use_freedv)
+        self.source = audio.FreeDVSource(self.rx_buffer, self.rx_fdv, self.settings['rx_jitter_target_ms'],
+                                         self.recorder, self.rate, self.labels)
+        self.source.set_receive_freedv(self.use_freedv)
+
+        try:
+            self.vc = await channel.connect()
+        except Exception:
+            self.sink = None
+            self.source = None
+            raise
+
+        self.tx_gate = TXGate(self.sink, self.rig, self.settings['tx_vad_threshold_db'],
+                              self.settings['tx_attack_ms'] / 1000, self.settings['tx_hang_ms'] / 1000,
+                              self.settings['tx_min_key_ms'] / 1000, self.block_samples / self.rate, self.labels)
+        await asyncio.to_thread(self.pipeline.set_stages, [self.sink, self.source, self.tx_gate])
+
+        self.vc.start_recording(self.sink, on_voice_leave, text_channel)
+        self.vc.play(self.source, wait_finish=False)
+
+    async def leave(self):
+        # no frame is still running the old stages once this returns, so nothing can key up after release()
+        await asyncio.to_thread(self.pipeline.set_stages, [])
+        await self.tx_gate.release()
+        self.tx_gate = None
+
+        self.vc.stop()
+        await self.vc.disconnect()
+        self.vc = None
+        self.sink = None
+        self.source = None
+
+    def set_freedv(self, value: bool):
+        self.use_freedv = value
+
+        if self.sink:
+            self.sink.set_transmit_freedv(value)
+            self.source.set_receive_freedv(value)
+
+    def close(self):
+        # safe to call on a station that only partly started
+        if self.pipeline.is_alive():
+            self.pipeline.stop()
+
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+        if self.rx_fdv is not None and self.rx_fdv is not self.fdv:
+            self.rx_fdv.close()
+
+        if self.fdv:
+            self.fdv.close()
+
+        self.fdv = None
+        self.rx_fdv = None
+
+        if self.rig:
+            self.rig.close()
+            self.rig = None
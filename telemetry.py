@@ -0,0 +1,134 @@
+import threading
+import time
+import numpy as np
+
+# one row per sample, frames and frame_errors are running totals so any window can be diffed
+STATS_DTYPE = np.dtype([('time', 'f8'), ('sync', 'u1'), ('snr', 'f4'), ('foff', 'f4'), ('clock_offset', 'f4'),
+                        ('sync_metric', 'f4'), ('frames', 'i8'), ('frame_errors', 'i8')])
+
+# darkest to brightest, for the waterfall
+SHADES = ' .:-=+*#%@'
+BARS = ' ▁▂▃▄▅▆▇█'
+
+
+class ModemTelemetry:
+    # Modem stats sampled from the RX path, at most once per interval, into a fixed size ring, plus
+    # the last few seconds of modem audio for a spectrum. The RX path only ever copies a few numbers
+    # and one block of samples, the FFT runs on whichever thread asks for it.
+    def __init__(self, interval: float = 0.5, history_seconds: float = 600, audio_seconds: float = 4,
+                 rate: int = 8000):
+        self.interval = interval
+        self.history = np.zeros(int(history_seconds / interval), dtype=STATS_DTYPE)
+        self.count = 0
+        self.next_sample = 0.0
+
+        self.rate = rate
+        self.audio = np.zeros(int(audio_seconds * rate), dtype=np.int16)
+        self.audio_pos = 0
+        self.audio_filled = 0
+
+        self.lock = threading.Lock()
+
+    def due(self):
+        now = time.monotonic()
+        if now < self.next_sample:
+            return False
+
+        self.next_sample = now + self.interval
+        return True
+
+    def record(self, sync: int, snr: float, foff: float, clock_offset: float, sync_metric: float, frames: int,
+               frame_errors: int):
+        with self.lock:
+            self.history[self.count % len(self.history)] = (time.monotonic(), sync, snr, foff, clock_offset,
+                                                            sync_metric, frames, frame_errors)
+            self.count += 1
+
+    def capture(self, samples: np.ndarray):
+        # keeps only the newest samples, overwriting the oldest
+        samples = samples[-len(self.audio):]
+        n = len(samples)
+        first = min(n, len(self.audio) - self.audio_pos)
+
+        self.audio[self.audio_pos:self.audio_pos + first] = samples[:first]
+        self.audio[:n - first] = samples[first:]
+
+        self.audio_pos = (self.audio_pos + n) % len(self.audio)
+        self.audio_filled = min(self.audio_filled + n, len(self.audio))
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+            self.next_sample = 0.0
+            self.audio_filled = 0
+
+    def samples(self, seconds: float | None = None):
+        # oldest first, a copy the RX path can't change underneath the caller
+        with self.lock:
+            n = min(self.count, len(self.history))
+            rows = np.roll(self.history, -(self.count % len(self.history)))[len(self.history) - n:]
+
+        if seconds is not None:
+            rows = rows[rows['time'] >= time.monotonic() - seconds]
+
+        return rows
+
+    def latest(self, field: str, default: float = 0.0):
+        with self.lock:
+            if not self.count:
+                return default
+
+            return float(self.history[(self.count - 1) % len(self.history)][field])
+
+    def summary(self, seconds: float = 60):
+        rows = self.samples(seconds)
+        if len(rows) == 0:
+            return None
+
+        synced = rows[rows['sync'] > 0]
+        last = rows[-1]
+        frames = int(last['frames'] - rows[0]['frames'])
+        frame_errors = int(last['frame_errors'] - rows[0]['frame_errors'])
+
+        return {
+            'age': time.monotonic() - float(last['time']),
+            'sync': bool(last['sync']),
+            'sync_percent': 100 * len(synced) / len(rows),
+            'snr': float(last['snr']),
+            'snr_mean': float(synced['snr'].mean()) if len(synced) else None,
+            'snr_min': float(synced['snr'].min()) if len(synced) else None,
+            'snr_max': float(synced['snr'].max()) if len(synced) else None,
+            'foff': float(last['foff']),
+            'clock_offset': float(last['clock_offset']),
+            'sync_metric': float(last['sync_metric']),
+            'frames': frames,
+            'frame_errors': frame_errors,
+        }
+
+    def audio_snapshot(self):
+        # the RX path may write while this copies, which at worst smears one block of the spectrum
+        audio = np.roll(self.audio, -self.audio_pos)
+        return audio[len(audio) - self.audio_filled:]
+
+    def spectrum(self, rows: int = 1, columns: int = 48, nfft: int = 512):
+        # averaged FFTs over each of `rows` slices of the captured audio, oldest first, then decimated to
+        # `columns` bins by keeping the strongest bin of each group. power in dB, shape (rows, columns)
+        audio = self.audio_snapshot().astype(np.float32)
+        frames_per_row = len(audio) // nfft // rows
+        if frames_per_row == 0:
+            return None
+
+        frames = audio[len(audio) - rows * frames_per_row * nfft:].reshape(rows, frames_per_row, nfft)
+        power = (np.abs(np.fft.rfft(frames * np.hanning(nfft).astype(np.float32), axis=2)) ** 2).mean(axis=1)
+
+        edges = np.linspace(0, power.shape[1], columns + 1).astype(int)[:-1]
+        return 10 * np.log10(np.maximum.reduceat(power, edges, axis=1) + 1e-9)
+
+
+def render_spectrum(power: np.ndarray, dynamic_range: float = 60, chars: str = BARS):
+    # one line of text per row, scaled so the strongest bin is the brightest character
+    top = power.max()
+    levels = np.clip((power - (top - dynamic_range)) / dynamic_range, 0, 1)
+    indices = np.rint(levels * (len(chars) - 1)).astype(int)
+
+    return [''.join(chars[i] for i in row) for row in indices]
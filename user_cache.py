@@ -0,0 +1,54 @@
+import asyncio
+import time
+import discord
+
+
+class UserNameCache:
+    # Turns discord user ids into display names without a REST call per user. Names come from this
+    # cache while they are fresh, then from the members and users the gateway has already sent us,
+    # and only the rest are fetched, a few at a time so a long operator list doesn't hit rate limits.
+    def __init__(self, bot: discord.Bot, ttl: float = 3600, max_concurrency: int = 5):
+        self.bot = bot
+        self.ttl = ttl
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.names = {}
+
+    def get_cached(self, user_id: int, guild: discord.Guild | None):
+        entry = self.names.get(user_id)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+
+        user = (guild.get_member(user_id) if guild else None) or self.bot.get_user(user_id)
+        if user:
+            self.store(user_id, user.display_name)
+            return user.display_name
+
+        return None
+
+    def store(self, user_id: int, name: str):
+        self.names[user_id] = (name, time.monotonic())
+
+    async def fetch(self, user_id: int):
+        async with self.semaphore:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord.NotFound:
+                name = f'Unknown user {user_id}'
+            except discord.HTTPException as e:
+                # not cached, so the next lookup tries again
+                print(f'Error fetching discord user {user_id}: {e}')
+                return str(user_id)
+            else:
+                name = user.display_name
+
+        self.store(user_id, name)
+        return name
+
+    async def resolve(self, user_ids, guild: discord.Guild | None = None):
+        names = {user_id: self.get_cached(user_id, guild) for user_id in user_ids}
+
+        missing = [user_id for user_id, name in names.items() if name is None]
+        for user_id, name in zip(missing, await asyncio.gather(*(self.fetch(user_id) for user_id in missing))):
+            names[user_id] = name
+
+        return names